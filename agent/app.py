@@ -2,17 +2,40 @@ from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from langgraph.graph import StateGraph, END
 import uvicorn
-from dialogue_manager import get_initial_state, create_workflow
-from langchain_core.messages import HumanMessage, AIMessage
+from dialogue_manager import get_initial_state, create_workflow, greeting_pool, generate_greeting
+from db import get_connection_manager
+from tools import search_cache, ranking_cache, FUZZY_MATCH_MODE, ProductLookupTool, transform_to_product_table
+from fuzzy_match import get_matcher
+from archive import search_archive
+from concurrency import blocking_pool_stats, run_blocking
+from metrics import node_latency
+from llm_cache import llm_cache
+from prefetch import product_prefetcher
+from history import compact_history, session_history
+from llm_gateway import busy_notifier, llm_gateway, llm_calls
+from prefetch import product_lookups
+from session import session_store
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk
 from pydantic import BaseModel
 import asyncio
 import json
+import os
+import time
+from typing import Optional
+from uuid import uuid4
 
 app = FastAPI()
 
 workflow = create_workflow()
 counter = 0
 
+# Nodes whose LLM output is shown to the user as-is, so it can be streamed token by token.
+# gather_marketing_brief is left out, its LLM output is JSON for the parser.
+STREAMED_NODES = {"greet", "get_product_table"}
+
+# Extra result pages pushed right after the first table, before the client asks for them
+TABLE_STREAM_PAGES = int(os.getenv("TABLE_STREAM_PAGES", "0"))
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Fix to allow all origins
@@ -24,29 +47,211 @@ app.add_middleware(
 class ChatInput(BaseModel):
     message: str
 
+@app.on_event("startup")
+async def load_catalog():
+    # Build the search index, category rollup and trigram matcher before the first session needs them
+    db = get_connection_manager()
+    db.prepare()
+    if FUZZY_MATCH_MODE != "off":
+        get_matcher(db)
+    # Pre-generate greetings in the background so connections don't wait on the LLM
+    greeting_pool.ensure_filling(generate_greeting)
+    # Write dirty sessions back to Redis in the background
+    if session_store is not None:
+        session_store.start()
+
+@app.on_event("shutdown")
+async def flush_sessions():
+    if session_store is not None:
+        await session_store.close()
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "db": get_connection_manager().stats(),
+        "search_cache": search_cache.stats(),
+        "ranking_cache": ranking_cache.stats(),
+        "search_archive": search_archive.stats(),
+        "blocking_pool": blocking_pool_stats(),
+        "node_latency": node_latency.summary(),
+        "greeting_pool": {"size": len(greeting_pool.greetings), "target": greeting_pool.size},
+        "llm_cache": llm_cache.stats() if llm_cache is not None else None,
+        "product_prefetch": product_prefetcher.stats(),
+        "session_history": session_history.summary(),
+        "llm_gateway": llm_gateway.stats(),
+        "single_flight": {"product_lookup": product_lookups.stats(), "llm": llm_calls.stats()},
+        "sessions": session_store.stats() if session_store is not None else None,
+    }
+
+async def send_table_page(websocket: WebSocket, table_id: str, query: str, cursor: str):
+    """ Fetch the page after `cursor` and send it as a table_page delta, returning the next cursor """
+    page = await run_blocking(ProductLookupTool().next_page, query, cursor)
+    table = transform_to_product_table(page)
+    await websocket.send_json({
+        "type": "table_page",
+        "table_id": table_id,
+        "query": query,
+        "rows": table["rows"],
+        "next_cursor": table["next_cursor"]
+    })
+    return table["next_cursor"]
+
+async def send_reply(websocket: WebSocket, state: dict, stream_id: Optional[str] = None) -> dict:
+    """
+    Send the last assistant message (with the product table, if there is one).
+    If its tokens were already streamed, close the stream with the final content instead.
+    """
+    msgs = state["conversation_history"]
+    if not (msgs and isinstance(msgs[-1], AIMessage)):
+        return state
+
+    table = None
+    # Check if we have a product_table in state
+    if state.get("product_table"):
+        table = {**state["product_table"], "table_id": uuid4().hex}
+
+    if stream_id:
+        await websocket.send_json({"type": "stream_end", "id": stream_id, "text": msgs[-1].content, "table": table})
+    elif table:
+        # Create a structured message with both text and table
+        print("Sending complex message with table")
+        await websocket.send_json({"type": "complex", "text": msgs[-1].content, "table": table})
+    else:
+        await websocket.send_text(msgs[-1].content)
+
+    if table:
+        # Stream a few more pages straight away, the rest on request
+        cursor = table.get("next_cursor")
+        for _ in range(TABLE_STREAM_PAGES):
+            if not cursor:
+                break
+            cursor = await send_table_page(websocket, table["table_id"], table["query"], cursor)
+
+        # Remove product_table from state after sending
+        state = {**state}
+        del state["product_table"]
+
+    return state
+
+async def run_turn(websocket: WebSocket, state: dict, config: dict, first_step_only: bool = False) -> dict:
+    """
+    Run the workflow for one turn. LLM tokens from user-facing nodes are streamed
+    as stream_start / stream_delta / stream_end messages, and each node's
+    time-to-first-token and total latency are recorded.
+    """
+    streams = {}  # node -> id of the stream open for it
+    node_start = time.perf_counter()
+    finished_node = None  # node whose update lands in the next "values" event
+
+    async def notify_busy(info: dict):
+        await websocket.send_json({"type": "busy", **info})
+
+    # Picked up by the LLM gateway when this turn's calls have to queue
+    busy_notifier.set(notify_busy)
+
+    async for mode, payload in workflow.astream(state, config=config, stream_mode=["updates", "messages", "values"]):
+        if mode == "messages":
+            chunk, metadata = payload
+            node = metadata.get("langgraph_node")
+            if node not in STREAMED_NODES or not isinstance(chunk, AIMessageChunk) or not chunk.content:
+                continue
+
+            if node not in streams:
+                streams[node] = uuid4().hex
+                node_latency.record(f"{node}.ttft", time.perf_counter() - node_start)
+                await websocket.send_json({"type": "stream_start", "id": streams[node], "node": node})
+            await websocket.send_json({"type": "stream_delta", "id": streams[node], "delta": chunk.content})
+            continue
+
+        if mode == "updates":
+            # Nodes only return what they changed, the merged state follows as "values"
+            if payload:
+                finished_node = next(iter(payload))
+                node_latency.record(f"{finished_node}.total", time.perf_counter() - node_start)
+            continue
+
+        if finished_node is None:
+            # The turn's input, echoed before the first node runs
+            continue
+
+        state = payload  # ✅ Persist updated state
+        node_start = time.perf_counter()
+        print(f"🚀 Transitioning to: {state['current_node']}")  # Debugging
+
+        state = await send_reply(websocket, state, streams.pop(finished_node, None))
+        finished_node = None
+
+        if first_step_only:
+            break
+
+    return state
+
+def replay_message(state: dict) -> Optional[dict]:
+    """
+    What a reconnecting client is shown: the last assistant message, with the
+    product table rebuilt from the stored search results if the conversation
+    ended on it. Nothing here runs a graph node or calls the LLM.
+    """
+    reply = next((m for m in reversed(state["conversation_history"]) if isinstance(m, AIMessage)), None)
+    if reply is None:
+        return None
+
+    table = None
+    if state["current_node"] == END and state.get("product_search_results"):
+        table = {**transform_to_product_table(state["product_search_results"]), "table_id": uuid4().hex}
+    return {"text": reply.content, "table": table}
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     global counter
     await websocket.accept()
+    connect_start = time.perf_counter()
+
+    # A client that was here before presents its session token to pick up where it left off
+    token = websocket.query_params.get("session")
+    state = None
+    if session_store is not None and token:
+        try:
+            state = await session_store.get_state(token)
+        except Exception as e:
+            # Redis down or an unreadable payload: start the client on a new session instead
+            print(f"Could not resume session {token}: {e}")
+            state = None
+    resumed = state is not None
+
+    if resumed:
+        session_id = token
+    elif session_store is not None:
+        # Kept in memory and written to Redis behind the conversation
+        session_id = session_store.create_session()
+        state = await session_store.get_state(session_id)
+    else:
+        session_id = None
+        state = get_initial_state()
 
     counter += 1
-    thread_id = str(counter)
+    thread_id = session_id or str(counter)
 
     await websocket.send_text(f"THREAD_ID:{thread_id}")
-
-    state = get_initial_state()
     config = {"configurable": {"thread_id": thread_id}}
 
+    if session_id:
+        await websocket.send_json({
+            "type": "session",
+            "token": session_id,
+            "resumed": resumed,
+            "replay": replay_message(state) if resumed else None,
+        })
+        if resumed:
+            session_store.latency.record("resume", time.perf_counter() - connect_start)
+            print(f"Resumed session {session_id} at {state['current_node']}")
+
     try:
         if not state["conversation_history"]:
-            async for step_result in workflow.astream(state, config=config):
-                if step_result:
-                    node_name = next(iter(step_result))
-                    state = step_result[node_name]  # ✅ Persist state properly
-                    msgs = state["conversation_history"]
-                    if msgs and isinstance(msgs[-1], AIMessage):
-                        await websocket.send_text(msgs[-1].content)
-                    break  # ✅ Stops greet from looping
+            # Only run greet, not the rest of the graph
+            state = await run_turn(websocket, state, config, first_step_only=True)
+            if session_id:
+                session_store.save_state(session_id, state)
 
         while True:
             user_message = await websocket.receive_text()
@@ -54,6 +259,18 @@ async def websocket_endpoint(websocket: WebSocket):
             # Try to parse as JSON to check if it's a category selection
             try:
                 json_data = json.loads(user_message)
+                if not isinstance(json_data, dict):
+                    raise json.JSONDecodeError("Not a JSON object", user_message, 0)
+
+                if json_data.get("type") == "table_page_request":
+                    try:
+                        await send_table_page(
+                            websocket, json_data.get("table_id"), json_data["query"], json_data["cursor"]
+                        )
+                    except (KeyError, ValueError) as e:
+                        await websocket.send_json({"type": "error", "message": f"Could not load more results: {e}"})
+                    continue
+
                 if json_data.get("type") == "audience_selection":
                     categories = json_data.get("categories", [])
                     print(f"Received selection of {len(categories)} categories")
@@ -69,6 +286,8 @@ async def websocket_endpoint(websocket: WebSocket):
                     categories_text = ", ".join(category_details)
 
                     state["audience_selections"] = categories
+                    if session_id:
+                        session_store.save_state(session_id, state)
         
                     print(f"Updated state with audience selections: {state['audience_selections']}")
                     
@@ -88,32 +307,13 @@ async def websocket_endpoint(websocket: WebSocket):
             if user_message.strip():
                 state["conversation_history"].append(HumanMessage(content=user_message))
 
-                async for step_result in workflow.astream(state, config=config):
-                    if step_result:
-                        node_name = next(iter(step_result))
-                        state = step_result[node_name]  # ✅ Persist updated state
-                        print(f"🚀 Transitioning to: {state['current_node']}")  # Debugging
-                        msgs = state["conversation_history"]
-                        
-                        if msgs and isinstance(msgs[-1], AIMessage):
-                            # Check if we have a product_table in state
-                            if "product_table" in state:
-                                # Create a structured message with both text and table
-                                message_data = {
-                                    "type": "complex",
-                                    "text": msgs[-1].content,
-                                    "table": state["product_table"]
-                                }
-                                print("Sending complex message with table")
-                                # Send as JSON
-                                await websocket.send_json(message_data)
-                                
-                                # Remove product_table from state after sending
-                                state = {**state}
-                                del state["product_table"]
-                            else:
-                                # Just send the text as before
-                                await websocket.send_text(msgs[-1].content)
+                state = await run_turn(websocket, state, config)
+
+                # Bound the session: keep the last turns, fold the rest into a summary
+                state = compact_history(state)
+                session_history.record(thread_id, state)
+                if session_id:
+                    session_store.save_state(session_id, state)
 
                 # ✅ Close WebSocket when workflow ends
                 if state["current_node"] == END:
@@ -127,6 +327,14 @@ async def websocket_endpoint(websocket: WebSocket):
     except Exception as e:
         print(f"Error in WebSocket handling: {e}")
         await websocket.close()
+    finally:
+        session_history.forget(thread_id)
+        if session_id:
+            try:
+                # Shielded: the handler may be cancelled once the client is gone
+                await asyncio.shield(session_store.flush(session_id))
+            except Exception as e:
+                print(f"Could not save session {session_id}: {e}")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Off by default: set SEARCH_ARCHIVE_SAMPLE_RATE to e.g. 0.05 in production
+# or 1 locally to keep what the old res.json dump used to give.
+SEARCH_ARCHIVE_PATH = os.getenv("SEARCH_ARCHIVE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "search_archive.jsonl.gz"))
+SEARCH_ARCHIVE_SAMPLE_RATE = float(os.getenv("SEARCH_ARCHIVE_SAMPLE_RATE", "0"))
+SEARCH_ARCHIVE_MAX_BYTES = int(os.getenv("SEARCH_ARCHIVE_MAX_BYTES", str(20 * 1024 * 1024)))
+SEARCH_ARCHIVE_BACKUPS = int(os.getenv("SEARCH_ARCHIVE_BACKUPS", "5"))
+SEARCH_ARCHIVE_QUEUE_SIZE = int(os.getenv("SEARCH_ARCHIVE_QUEUE_SIZE", "1000"))
+
+
+class SearchArchive:
+    """
+    Appends sampled search records to a gzip-compressed JSONL file from a
+    background thread. record() never blocks: if the queue is full the
+    record is dropped and counted.
+    """
+
+    def __init__(
+        self,
+        path: str = SEARCH_ARCHIVE_PATH,
+        sample_rate: float = SEARCH_ARCHIVE_SAMPLE_RATE,
+        max_bytes: int = SEARCH_ARCHIVE_MAX_BYTES,
+        backups: int = SEARCH_ARCHIVE_BACKUPS,
+        queue_size: int = SEARCH_ARCHIVE_QUEUE_SIZE,
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._stats = {"written": 0, "dropped": 0, "skipped": 0, "rotations": 0, "errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def record(self, entry: Dict) -> None:
+        """ Queue a record for the writer thread (subject to sampling) """
+        if not self.enabled or random.random() >= self.sample_rate:
+            self._count("skipped")
+            return
+
+        self._start()
+        try:
+            self._queue.put_nowait({"ts": time.time(), **entry})
+        except queue.Full:
+            self._count("dropped")
+
+    def close(self, timeout: float = 5) -> None:
+        """ Flush queued records and stop the writer thread """
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "queued": self._queue.qsize(), "sample_rate": self.sample_rate}
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="search-archive", daemon=True)
+                self._thread.start()
+
+    def _rotate(self) -> None:
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._count("rotations")
+
+    def _run(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        raw = open(self.path, "ab")
+        gz = gzip.GzipFile(fileobj=raw, mode="ab")
+
+        while True:
+            entry = self._queue.get()
+            try:
+                if entry is not None:
+                    gz.write((json.dumps(entry, default=str) + "\n").encode("utf-8"))
+                    self._count("written")
+
+                # Only flush when the queue is drained, so bursts share one gzip flush
+                if entry is None or self._queue.empty():
+                    gz.flush()
+                    if raw.tell() >= self.max_bytes:
+                        gz.close()
+                        raw.close()
+                        self._rotate()
+                        raw = open(self.path, "ab")
+                        gz = gzip.GzipFile(fileobj=raw, mode="ab")
+            except (OSError, TypeError, ValueError) as e:
+                print(f"Search archive write failed: {e}")
+                self._count("errors")
+
+            if entry is None:
+                gz.close()
+                raw.close()
+                return
+
+
+search_archive = SearchArchive()
+atexit.register(search_archive.close)
@@ -0,0 +1,1097 @@
+"""
+Latency benchmarks for the agent's hot paths.
+
+Run from the agent/ directory, e.g.
+
+    python benchmark.py search --rows 2000000
+    python benchmark.py fuzzy --rows 2000000
+    python benchmark.py pages --rows 2000000 --results 2000
+    python benchmark.py sessions --sessions 20
+    python benchmark.py brief
+    python benchmark.py prompt --rows 200000
+    python benchmark.py history --turns 1000
+    python benchmark.py gateway --requests 100
+    python benchmark.py coalesce --sessions 50
+    python benchmark.py dispatch
+    python benchmark.py store --turns 200          (fakeredis, or --redis-url)
+    python benchmark.py codec --turns 5 20 50
+    python benchmark.py resume --reconnects 50     (fakeredis)
+
+The sessions benchmark drives the real LangGraph workflow against a fake
+LLM with fixed latency, so no Azure credentials are needed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from search_index import ensure_search_index, search_products, search_products_page, SEARCH_LIMIT
+from fuzzy_match import TrigramMatcher, fetch_rows
+from brief_extractor import extract_brief, has_content, BRIEF_FIELDS
+from prompt_budget import build_table_prompt, count_tokens, PROMPT_TABLE_TOKEN_BUDGET
+from history import HISTORY_WINDOW_TURNS
+from llm_gateway import LLM_QUEUE_TIMEOUT
+
+BRANDS = [
+    "Kit Kat", "Twix", "Mars", "Snickers", "Galaxy", "Dairy Milk", "Aero", "Yorkie",
+    "Lion", "Maltesers", "Bounty", "Rolo", "Toffee Crisp", "Wispa", "Crunchie", "Munchies",
+    "Heinz", "Walkers", "Pringles", "Hovis", "Warburtons", "Lurpak", "Anchor", "Cathedral City",
+]
+VARIANTS = ["Chunky", "Orange", "White", "Caramel", "Mint", "Duo", "Biscoff", "Peanut", "Salted", "Original"]
+SIZES = ["41G", "48G", "70G", "4PK", "9PK", "Shipper C4", "Sharing Bag", "Multipack"]
+CATEGORIES = [
+    ("Single Confectionery", "Singles"), ("Single Confectionery", "Prem Choc"),
+    ("Sharing Confectionery", "Bags"), ("Multipack Confectionery", "Multipacks"),
+    ("Crisps & Snacks", "Sharing Crisps"), ("Bakery", "Bread"), ("Dairy", "Butter & Spreads"),
+    ("Dairy", "Cheddar"), ("NOT IN USE", "NOT IN USE"),
+]
+
+SEARCH_QUERIES = ["kit kat", "twix", "dairy milk", "cathedral city", "walkers", "kit kat chunky"]
+TYPO_QUERIES = ["kitkat", "kit-kat chunky", "diary milk", "cathedal city", "malteser", "snikers caramel"]
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label: str, samples: list) -> None:
+    """ Print p50/p99/mean for a list of latencies in seconds """
+    print(
+        f"{label:<28} n={len(samples):<6} "
+        f"p50={percentile(samples, 50) * 1000:9.3f}ms "
+        f"p99={percentile(samples, 99) * 1000:9.3f}ms "
+        f"mean={statistics.mean(samples) * 1000:9.3f}ms"
+    )
+
+
+def build_synthetic_catalog(db_path: str, rows: int, seed: int = 7, categories: int = 0) -> None:
+    """
+    Create a DIM_ITEMS table with the same columns as the production catalog.
+    categories > 0 spreads SKUs over that many generated product categories instead of CATEGORIES.
+    """
+    rng = random.Random(seed)
+    category_pairs = CATEGORIES
+    if categories:
+        category_pairs = [(f"Buyer Category {i // 10}", f"Product Category {i}") for i in range(categories)]
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS DIM_ITEMS (
+        skuId INTEGER,
+        skuName TEXT,
+        catLevel4Name TEXT,
+        catLevel5Name TEXT
+    )
+    """)
+
+    def generate():
+        for sku_id in range(1_000_000, 1_000_000 + rows):
+            name = f"{rng.choice(BRANDS)} {rng.choice(VARIANTS)} {rng.choice(SIZES)}"
+            if rng.random() < 0.5:
+                name = name.upper()
+            buyer_category, product_category = rng.choice(category_pairs)
+            yield (sku_id, name, buyer_category, product_category)
+
+    with conn:
+        conn.executemany("INSERT INTO DIM_ITEMS VALUES (?, ?, ?, ?)", generate())
+    conn.close()
+
+
+def time_queries(conn: sqlite3.Connection, use_index: bool, repeats: int) -> list:
+    samples = []
+    for _ in range(repeats):
+        for query in SEARCH_QUERIES:
+            start = time.perf_counter()
+            search_products(conn, query, use_index=use_index)
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_search(args) -> None:
+    """ Compare the legacy LIKE query with the FTS5 index on a synthetic catalog """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+
+        start = time.perf_counter()
+        build_synthetic_catalog(db_path, args.rows)
+        print(f"Built synthetic catalog with {args.rows:,} rows in {time.perf_counter() - start:.1f}s")
+
+        conn = sqlite3.connect(db_path)
+
+        start = time.perf_counter()
+        if not ensure_search_index(conn, db_path):
+            print("FTS5 unavailable in this sqlite build, nothing to compare")
+            return
+        print(f"Built FTS5 index in {time.perf_counter() - start:.1f}s")
+
+        report("LIKE scan (legacy)", time_queries(conn, use_index=False, repeats=args.repeats))
+        report("FTS5 + bm25", time_queries(conn, use_index=True, repeats=args.repeats))
+        conn.close()
+
+
+def bench_pages(args) -> None:
+    """
+    Time-to-first-row of keyset pages vs fetching the whole result in one query,
+    with later pages re-scored by sqlite or sliced from a cached ranking
+    """
+    from cache import TTLCache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        conn = sqlite3.connect(db_path)
+        if not ensure_search_index(conn, db_path):
+            print("FTS5 unavailable in this sqlite build, nothing to page")
+            return
+
+        def walk(query, ranking_cache):
+            """ Every page up to args.results; returns the rows and the time to the first page """
+            start = time.perf_counter()
+            rows, cursor = search_products_page(conn, query, limit=args.page_size, ranking_cache=ranking_cache)
+            first = time.perf_counter() - start
+            while cursor and len(rows) < args.results:
+                page, cursor = search_products_page(
+                    conn, query, cursor=cursor, limit=args.page_size, ranking_cache=ranking_cache
+                )
+                rows += page
+            return rows, first
+
+        one_shot, first_page, all_pages, all_ranked = [], [], [], []
+        for _ in range(args.repeats):
+            for query in SEARCH_QUERIES:
+                start = time.perf_counter()
+                expected = search_products(conn, query, limit=args.results)
+                one_shot.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                rows, first = walk(query, None)
+                all_pages.append(time.perf_counter() - start)
+                first_page.append(first)
+
+                # A fresh cache each walk, so the ranking query is part of the timing
+                start = time.perf_counter()
+                ranked, _ = walk(query, TTLCache(maxsize=1))
+                all_ranked.append(time.perf_counter() - start)
+                assert ranked == rows == expected[:len(rows)], f"pages for {query!r} differ"
+        conn.close()
+
+        report(f"One query, {args.results} rows", one_shot)
+        report(f"First page, {args.page_size} rows", first_page)
+        report(f"All pages up to {args.results}", all_pages)
+        report("  with cached ranking", all_ranked)
+
+
+def bench_fuzzy(args) -> None:
+    """ Build time, memory footprint and query latency of the trigram matcher """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        conn = sqlite3.connect(db_path)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        matcher = TrigramMatcher.from_connection(conn)
+        build_time = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"Built trigram matcher over {len(matcher):,} SKUs in {build_time:.1f}s")
+        print(f"Matrix: {matcher.matrix.nnz:,} non-zeros, {len(matcher.vocab):,} trigrams, "
+              f"{matcher.memory_bytes() / 1e6:.1f}MB held ({matcher.memory_bytes() / len(matcher):.0f} bytes/SKU)")
+        print(f"Python heap: {current / 1e6:.1f}MB retained, {peak / 1e6:.1f}MB peak during build")
+
+        samples = []
+        for _ in range(args.repeats):
+            for query in TYPO_QUERIES:
+                start = time.perf_counter()
+                fetch_rows(conn, [rowid for rowid, _ in matcher.search(query, k=50)])
+                samples.append(time.perf_counter() - start)
+        report("Trigram cosine top-50 + rows", samples)
+
+        for query in TYPO_QUERIES:
+            top = fetch_rows(conn, [rowid for rowid, _ in matcher.search(query, k=1)])
+            print(f"  {query!r:<20} -> {top[0][1] if top else None!r}")
+        conn.close()
+
+
+# Sample user messages with the brief we'd want out of them (None = not stated)
+SAMPLE_BRIEFS = [
+    ("Product is kit kat\nmain objective is conversion\nbudget is 20k\nchannel is meta\ncampaign will run for 1 month",
+     {"product_name": "kit kat", "objectives": "conversion", "budget": "20,000", "channel": "meta", "duration": "1 month"}),
+    ("Product is kit kat, objective conversion, budget 20k, meta, 1 month",
+     {"product_name": "kit kat", "objectives": "conversion", "budget": "20,000", "channel": "meta", "duration": "1 month"}),
+    ("We want to promote Twix Salted Caramel to drive awareness on TikTok and YouTube. Budget £50k over six weeks",
+     {"product_name": "Twix Salted Caramel", "objectives": "awareness", "budget": "£50,000", "channel": "tiktok, youtube", "duration": "6 weeks"}),
+    ("brand: Walkers; goal: sales and trial; spend $30,000; channels: facebook, instagram; running for a quarter",
+     {"product_name": "Walkers", "objectives": "sales, trial", "budget": "$30,000", "channel": "meta", "duration": "3 months"}),
+    ("Product name - Cathedral City Mature Cheddar. KPI is reach. Budget 1.2m GBP. Channels are TV and BVOD. Flight is 8 weeks",
+     {"product_name": "Cathedral City Mature Cheddar", "objectives": "reach", "budget": "£1,200,000", "channel": "tv, bvod", "duration": "8 weeks"}),
+    ("budget is 15k", {"budget": "15,000"}),
+    ("meta", {"channel": "meta"}),
+    ("2 weeks", {"duration": "2 weeks"}),
+    ("The product is Heinz Beanz, we need consideration, about €75k on programmatic display for 3 months",
+     {"product_name": "Heinz Beanz", "objectives": "consideration", "budget": "€75,000", "channel": "programmatic, display", "duration": "3 months"}),
+    ("Advertising Pringles Sour Cream with a 40 grand budget, goal is engagement, snapchat and tiktok, two months",
+     {"product_name": "Pringles Sour Cream", "objectives": "engagement", "budget": "40,000", "channel": "snapchat, tiktok", "duration": "2 months"}),
+    ("It's for the new Dairy Milk Biscoff bar, we want people to try it in store over the summer",
+     {"product_name": "Dairy Milk Biscoff bar", "objectives": "trial", "channel": "in-store", "duration": "3 months"}),
+    ("launching something for students, not sure of the budget yet", {}),
+    ("The product for this campaign is Kit Kat", {"product_name": "Kit Kat"}),
+    ("I want to promote it on meta next month", {"channel": "meta"}),
+]
+
+
+def bench_brief(args) -> None:
+    """ Accuracy and latency of the rule-based brief extractor on SAMPLE_BRIEFS """
+    samples, correct, expected_total, fallbacks = [], {field: 0 for field in BRIEF_FIELDS}, {field: 0 for field in BRIEF_FIELDS}, 0
+    wrong = []
+
+    for text, expected in SAMPLE_BRIEFS:
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            fields, leftover = extract_brief(text)
+            samples.append(time.perf_counter() - start)
+
+        for field in BRIEF_FIELDS:
+            if field in expected:
+                expected_total[field] += 1
+                if fields.get(field, "").lower() == expected[field].lower():
+                    correct[field] += 1
+            if fields.get(field, "").lower() != expected.get(field, "").lower():
+                wrong.append((text[:40], field, fields.get(field), expected.get(field)))
+
+        # Same rule as gather_marketing_brief on a fresh brief
+        if len(fields) < len(BRIEF_FIELDS) and has_content(leftover):
+            fallbacks += 1
+
+    report("Rule-based extraction", samples)
+    for field in BRIEF_FIELDS:
+        print(f"  {field:<14} {correct[field]}/{expected_total[field]} correct")
+    print(f"LLM fallback needed for {fallbacks}/{len(SAMPLE_BRIEFS)} messages")
+    print(f"Mean extraction time with a {args.llm_latency * 1000:.0f}ms LLM: "
+          f"{statistics.mean(samples) * 1000 + fallbacks / len(SAMPLE_BRIEFS) * args.llm_latency * 1000:.1f}ms "
+          f"(vs {args.llm_latency * 1000:.0f}ms LLM only)")
+    for text, field, got, want in wrong:
+        print(f"  mismatch {text!r:<44} {field}: got {got!r}, expected {want!r}")
+
+
+def bench_prompt(args) -> None:
+    """
+    Size, build time and LLM latency of the get_product_table prompt, full table vs
+    token budget, as results grow. The LLM is a stub whose latency grows with prompt tokens.
+    """
+    from search_index import count_matches_by_category
+    from tools import ProductLookupTool, transform_to_product_table
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows, categories=args.categories)
+        prompt_template = load_agent(db_path, 0).PRODUCT_TABLE_PROMPT
+        llm = make_fake_llm(args.llm_latency, args.seconds_per_1k_tokens)
+        conn = sqlite3.connect(db_path)
+        if not ensure_search_index(conn, db_path):
+            print("FTS5 unavailable in this sqlite build")
+            return
+
+        # Wide enough query to return every category
+        query = "kit kat"
+        match_counts = count_matches_by_category(conn, query)
+        count_tokens("warm up the tokenizer")
+
+        for limit in args.limits:
+            rows = search_products(conn, query, limit=limit)
+            results = ProductLookupTool._build_results(query, rows, match_counts, None)
+            table = transform_to_product_table(results, category_totals={})
+
+            for label, budget in (("full table", None), (f"budget {args.budget}", args.budget)):
+                samples = []
+                for _ in range(args.repeats):
+                    start = time.perf_counter()
+                    table_prompt = build_table_prompt(table, budget=budget)
+                    prompt = prompt_template.format(
+                        query=query,
+                        buyer_categories=table_prompt["buyer_categories"],
+                        product_categories=table_prompt["product_categories"],
+                        total_results=results.total_matches,
+                        table_data=table_prompt["table_data"],
+                    )
+                    samples.append(time.perf_counter() - start)
+
+                llm_samples = []
+                for _ in range(args.llm_repeats):
+                    start = time.perf_counter()
+                    asyncio.run(llm.ainvoke(prompt))
+                    llm_samples.append(time.perf_counter() - start)
+
+                tokens = count_tokens(prompt)
+                print(f"{limit:>6} results, {label:<12} {tokens:>6} prompt tokens "
+                      f"(${tokens / 1_000_000 * args.price_per_1m_tokens:.4f} per call), "
+                      f"{table_prompt['rows_included']}/{table_prompt['rows_total']} rows")
+                report("  build", samples)
+                report("  llm.ainvoke", llm_samples)
+
+            # A budget smaller than any row still gets the best one, not just the "...and N more" line
+            tiny = build_table_prompt(table, budget=20)
+            assert tiny["rows_included"] == 1, tiny
+            print(f"{limit:>6} results, budget 20     {tiny['table_tokens']:>6} table tokens, "
+                  f"{tiny['rows_included']}/{tiny['rows_total']} rows")
+        conn.close()
+
+
+FAKE_BRIEF = {
+    "product_name": "kit kat",
+    "objectives": "conversion",
+    "budget": "20k",
+    "channel": "meta",
+    "duration": "1 month",
+}
+
+
+def make_fake_llm(latency: float, seconds_per_1k_tokens: float = 0.0):
+    """
+    Chat model that waits `latency` seconds (blocking in sync calls) and returns a brief as JSON.
+    With seconds_per_1k_tokens the wait also grows with the prompt, like a real model's prefill.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+    class FakeLatencyChatModel(BaseChatModel):
+        latency: float = 0.5
+        seconds_per_1k_tokens: float = 0.0
+        calls: int = 0
+
+        @property
+        def _llm_type(self) -> str:
+            return "fake-latency"
+
+        def _result(self) -> ChatResult:
+            self.calls += 1
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=json.dumps(FAKE_BRIEF)))])
+
+        def _delay(self, messages) -> float:
+            if not self.seconds_per_1k_tokens:
+                return self.latency
+            tokens = sum(count_tokens(str(message.content)) for message in messages)
+            return self.latency + tokens / 1000 * self.seconds_per_1k_tokens
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            time.sleep(self._delay(messages))
+            return self._result()
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+            await asyncio.sleep(self._delay(messages))
+            return self._result()
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            # First token after half the latency plus prefill, the rest spread over the other half
+            content = self._result().generations[0].message.content
+            tokens = content.split(" ")
+            await asyncio.sleep(self._delay(messages) - self.latency / 2)
+            for i, token in enumerate(tokens):
+                text = token if i == len(tokens) - 1 else token + " "
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=text))
+                if run_manager:
+                    await run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+                await asyncio.sleep(self.latency / 2 / len(tokens))
+
+    return FakeLatencyChatModel(latency=latency, seconds_per_1k_tokens=seconds_per_1k_tokens)
+
+
+def load_agent(db_path: str, llm_latency: float):
+    """ Import the dialogue manager with the catalog and LLM swapped for local fakes """
+    for key, value in {
+        "AZURE_OAI_KEY": "benchmark",
+        "END_POINT": "https://benchmark.openai.azure.com",
+        "API_VERSION_GPT": "2024-06-01",
+    }.items():
+        os.environ.setdefault(key, value)
+
+    import db
+    import dialogue_manager
+
+    db.configure_database(db_path=db_path, immutable=False)
+    dialogue_manager.llm = make_fake_llm(llm_latency)
+    return dialogue_manager
+
+
+async def run_session(dialogue_manager, workflow) -> float:
+    """ One brief turn through gather_marketing_brief and get_product_table """
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    state = dialogue_manager.get_initial_state()
+    state["conversation_history"] = [
+        AIMessage(content="Hi! Share your brief."),
+        HumanMessage(content="Product is kit kat, objective conversion, budget 20k, meta, 1 month"),
+    ]
+    state["current_node"] = "gather_marketing_brief"
+
+    start = time.perf_counter()
+    async for _ in workflow.astream(state):
+        pass
+    return time.perf_counter() - start
+
+
+def bench_history(args) -> None:
+    """ Per-turn latency should stay flat as a session's history grows """
+    from langchain_core.messages import AIMessage, HumanMessage
+    from schema import append_messages
+    from history import compact_history, history_bytes
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        dialogue_manager = load_agent(db_path, 0)
+        workflow = dialogue_manager.create_workflow()
+
+        async def main():
+            state = dialogue_manager.get_initial_state()
+            state["conversation_history"] = [AIMessage(content="Hi! Share your brief.")]
+            state["current_node"] = "gather_marketing_brief"
+            first_message = "Product is kit kat, objective conversion, budget 20k, meta, 1 month"
+
+            samples = []
+            for turn in range(args.turns):
+                state["conversation_history"].append(HumanMessage(content=first_message if turn == 0 else "thanks"))
+                start = time.perf_counter()
+                async for state in workflow.astream(state, stream_mode="values"):
+                    pass
+                # Same as the websocket loop between turns
+                state = compact_history(state, window=args.window)
+                samples.append(time.perf_counter() - start)
+            return state, samples
+
+        state, samples = asyncio.run(main())
+        print(f"{len(state['conversation_history'])} messages, {state.get('folded_turns') or 0} turns summarized, "
+              f"{history_bytes(state):,} bytes of history after {args.turns} turns (window {args.window})")
+        print(f"brief_data kept: {state['brief_data']}")
+        bucket = max(1, args.turns // 10)
+        for start in range(0, args.turns, bucket):
+            report(f"Turns {start + 1}-{start + bucket}", samples[start:start + bucket])
+
+    # The history update alone: the reducer copies the list, which compaction keeps short
+    for label, window in (("append, unbounded", None), ("append, compacted", HISTORY_WINDOW_TURNS * 2)):
+        history, samples = [AIMessage(content="hi")], []
+        for _ in range(args.turns * 3):
+            start = time.perf_counter()
+            history = append_messages(history, [AIMessage(content="reply")])
+            samples.append(time.perf_counter() - start)
+            if window:
+                history = history[-window:]
+        report(f"{label}, last {args.turns}", samples[-args.turns:])
+
+
+def bench_sessions(args) -> None:
+    """ N concurrent sessions should take about as long as one """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        dialogue_manager = load_agent(db_path, args.llm_latency)
+        workflow = dialogue_manager.create_workflow()
+
+        async def main():
+            # Warm up the pool, search index and caches
+            await run_session(dialogue_manager, workflow)
+
+            single = [await run_session(dialogue_manager, workflow) for _ in range(3)]
+            report("1 session", single)
+
+            start = time.perf_counter()
+            concurrent = await asyncio.gather(*[run_session(dialogue_manager, workflow) for _ in range(args.sessions)])
+            wall = time.perf_counter() - start
+            report(f"{args.sessions} concurrent sessions", list(concurrent))
+            print(f"Wall time for {args.sessions} sessions: {wall * 1000:.1f}ms "
+                  f"({wall / statistics.median(single):.2f}x a single session)")
+
+        asyncio.run(main())
+
+
+# A scripted conversation and the nodes the router should run for each turn
+DISPATCH_SCRIPT = [
+    (None, ["greet"]),
+    ("budget is 20k", ["gather_marketing_brief"]),
+    ("product is kit kat, objective conversion, meta, 1 month", ["gather_marketing_brief", "get_product_table"]),
+    ("thanks", ["gather_marketing_brief"]),
+    ("actually the product is twix", ["gather_marketing_brief", "get_product_table"]),
+]
+
+
+def bench_dispatch(args) -> None:
+    """ Nodes run and LLM calls per turn, router entry vs replaying the graph from greet """
+    from langchain_core.messages import HumanMessage
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        dialogue_manager = load_agent(db_path, 0)
+        dialogue_manager.greeting_pool.greetings = ["Hi! Share your brief."]
+        fake_llm = dialogue_manager.llm
+
+        async def run_turn(workflow, state, first_step_only):
+            nodes = []
+            async for mode, payload in workflow.astream(state, stream_mode=["updates", "values"]):
+                if mode == "updates" and payload:
+                    nodes.extend(payload)
+                elif mode == "values" and nodes:
+                    state = payload
+                    if first_step_only:
+                        break
+            return state, nodes
+
+        async def main(dispatch):
+            workflow = dialogue_manager.create_workflow(dispatch)
+            state, turns = dialogue_manager.get_initial_state(), []
+            for message, _ in DISPATCH_SCRIPT:
+                if message is not None:
+                    state["conversation_history"].append(HumanMessage(content=message))
+                calls = fake_llm.calls
+                start = time.perf_counter()
+                # Same as the websocket: the greeting turn stops after its first node
+                state, nodes = await run_turn(workflow, state, first_step_only=message is None)
+                turns.append((nodes, fake_llm.calls - calls, time.perf_counter() - start))
+            return turns
+
+        for dispatch in ("replay", "router"):
+            turns = asyncio.run(main(dispatch))
+            print(f"{dispatch}: {sum(len(nodes) for nodes, _, _ in turns)} node runs, "
+                  f"{sum(calls for _, calls, _ in turns)} LLM calls")
+            for (message, expected), (nodes, calls, elapsed) in zip(DISPATCH_SCRIPT, turns):
+                print(f"  {message or '<connect>'!r:<60} {' -> '.join(nodes):<50} "
+                      f"{calls} LLM calls, {elapsed * 1000:.1f}ms")
+                if dispatch == "router":
+                    assert nodes == expected, f"{message!r}: ran {nodes}, expected {expected}"
+        print("Router node counts match the script")
+
+
+def legacy_json(state: dict) -> str:
+    """ A state as the old SessionManager stored it: role/content dicts and JSON text """
+    history = [
+        {"role": "user" if type(m).__name__ == "HumanMessage" else "assistant", "content": m.content}
+        if not isinstance(m, dict) else m
+        for m in state["conversation_history"]
+    ]
+    return json.dumps({**state, "conversation_history": history}, default=lambda v: v.model_dump(mode="json"))
+
+
+def make_session_state(turns: int, results, reply_chars: int = 400) -> dict:
+    """ A session `turns` turns in, with search results and audience selections """
+    from langchain_core.messages import AIMessage, HumanMessage
+    from schema import AudienceSelections, SelectedCategory
+
+    state = {
+        "conversation_history": [],
+        "conversation_summary": "- User: product is kit kat | Assistant: Great, we have all the details" if turns > 20 else None,
+        "folded_turns": max(0, turns - 20),
+        "product_name": "kit kat",
+        "product_search_results": results,
+        "audience_selections": AudienceSelections(categories=[
+            SelectedCategory(buyer_category=buyer, product_category=product)
+            for buyer, product in zip(results.buyer_categories, results.product_categories)
+        ]),
+        "brief_data": dict(FAKE_BRIEF),
+        "current_node": "__end__",
+    }
+    for turn in range(turns):
+        state["conversation_history"].append(HumanMessage(content=f"Turn {turn}: which categories work best for kit kat?"))
+        state["conversation_history"].append(AIMessage(
+            content=(f"**Reply {turn}** 🍫 " + "The Confectionery > Chocolate combination converts best. " * 10)[:reply_chars],
+            id=f"run-{turn}",
+            response_metadata={"finish_reason": "stop"},
+        ))
+    return state
+
+
+def bench_codec(args) -> None:
+    """ Encode/decode time and size of a session state: JSON text vs the msgpack codec """
+    from search_index import count_matches_by_category
+    from tools import ProductLookupTool
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        load_agent(db_path, 0)
+        import state_codec
+
+        conn = sqlite3.connect(db_path)
+        ensure_search_index(conn, db_path)
+        results = ProductLookupTool._build_results(
+            "kit kat", search_products(conn, "kit kat"), count_matches_by_category(conn, "kit kat"), None
+        )
+        conn.close()
+
+    def legacy_load(payload):
+        """ json.loads, then rebuild the objects the graph works with """
+        from langchain_core.messages import AIMessage, HumanMessage
+        from schema import AudienceSelections, ProductSearchResults
+
+        state = json.loads(payload)
+        state["conversation_history"] = [
+            (HumanMessage if m["role"] == "user" else AIMessage)(content=m["content"])
+            for m in state["conversation_history"]
+        ]
+        state["product_search_results"] = ProductSearchResults.model_validate(state["product_search_results"])
+        state["audience_selections"] = AudienceSelections.model_validate(state["audience_selections"])
+        return state
+
+    codecs = [
+        ("json", legacy_json, json.loads),
+        ("json+objects", legacy_json, legacy_load),
+        ("msgpack", lambda state: state_codec.encode(state, compress_threshold=None), state_codec.decode),
+        ("msgpack+zstd", state_codec.encode, state_codec.decode),
+    ]
+    for turns in args.turns:
+        state = make_session_state(turns, results)
+        print(f"{turns} turns, {len(results)} search results:")
+        for label, encode, decode in codecs:
+            payload = encode(state)
+            if label.startswith("msgpack"):
+                decoded = decode(payload)
+                assert decoded == state, f"{label} didn't round-trip"
+            timings = {"encode": [], "decode": []}
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                encode(state)
+                timings["encode"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                decode(payload)
+                timings["decode"].append(time.perf_counter() - start)
+            print(f"  {label:<13} {len(payload):>9,} bytes  "
+                  f"encode p50 {percentile(timings['encode'], 50) * 1000:7.3f}ms  "
+                  f"decode p50 {percentile(timings['decode'], 50) * 1000:7.3f}ms")
+
+
+def bench_store(args) -> None:
+    """ Bytes written to Redis per turn should stay flat as a session grows; hot sessions never read Redis """
+    from langchain_core.messages import AIMessage, HumanMessage
+    from redis.asyncio import Redis
+    from history import compact_history
+    from schema import ProductSearchResults
+
+    if args.redis_url:
+        redis = Redis.from_url(args.redis_url)
+    else:
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("Pass --redis-url or pip install fakeredis")
+        redis = fakeredis.FakeAsyncRedis()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, 1_000)
+        dialogue_manager = load_agent(db_path, 0)
+        from session import SessionManager
+
+        rows = [(f"SKU{i}", f"Product {i} " + "x" * 40, f"Buyer {i % 6}", f"Category {i % 8}") for i in range(SEARCH_LIMIT)]
+        results = ProductSearchResults.from_rows("kit kat", rows, total_results=len(rows))
+
+        async def main():
+            manager = SessionManager(redis=redis)
+            session_id = manager.create_session()
+            await manager.flush()
+
+            legacy, delta, request = [], [], []
+            for turn in range(args.turns):
+                start = time.perf_counter()
+                state = await manager.get_state(session_id)
+                state["conversation_history"].append(HumanMessage(content=f"Turn {turn}: " + "tell me more " * 15))
+                state["conversation_history"].append(AIMessage(content=f"Reply {turn}: " + "here is more detail " * 20))
+                if turn == 2:
+                    state["product_search_results"] = results
+                state["current_node"] = "gather_marketing_brief" if turn % 2 else dialogue_manager.END
+                # As the turn loop in app.py does
+                state = compact_history(state)
+                manager.save_state(session_id, state)
+                request.append(time.perf_counter() - start)
+
+                # What the single-blob SETEX wrote: the whole state, every turn
+                legacy.append(len(legacy_json(await manager.get_state(session_id))))
+
+                # One flush per turn, as if the flush interval elapsed
+                written = manager.stats()["bytes_written"]
+                await manager.flush()
+                delta.append(manager.stats()["bytes_written"] - written)
+
+            # A fresh manager (another worker) reads back the same state from Redis
+            reloaded = await SessionManager(redis=redis).get_state(session_id)
+            state = await manager.get_state(session_id)
+            assert reloaded["conversation_history"] == state["conversation_history"]
+            assert reloaded["product_search_results"] == results
+            return manager, state, legacy, delta, request, await redis.llen(f"session:{session_id}:messages")
+
+        manager, state, legacy, delta, request, stored = asyncio.run(main())
+
+        bucket = max(1, args.turns // 10)
+        print(f"{len(state['conversation_history'])} messages kept, {state.get('folded_messages') or 0} folded "
+              f"after {args.turns} turns; {stored} in the Redis list")
+        print(f"{'turns':<12} {'single blob':>14} {'delta':>10}   (bytes written per turn)")
+        for start in range(0, args.turns, bucket):
+            end = min(start + bucket, args.turns)
+            print(f"{start + 1:>4}-{end:<7} {statistics.mean(legacy[start:end]):>14,.0f} "
+                  f"{statistics.mean(delta[start:end]):>10,.0f}")
+        print(f"Total: {sum(legacy):,} bytes as one blob, {sum(delta):,} as deltas")
+        report("get + save (in memory)", request)
+        stats = manager.stats()
+        print(f"hit_rate={stats['hit_rate']:.3f} misses={stats['misses']} flushes={stats['flushes']} "
+              f"blobs_written={stats['blobs_written']} latency={stats['latency']}")
+
+def bench_resume(args) -> None:
+    """ Reconnecting with a session token: latency, and no graph nodes or LLM calls """
+    import fakeredis
+    from fastapi.testclient import TestClient
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        dialogue_manager = load_agent(db_path, args.llm_latency)
+        dialogue_manager.greeting_pool.greetings = ["Hi! Share your brief."]
+        dialogue_manager.greeting_pool.size = 1
+        fake_llm = dialogue_manager.llm
+
+        import app
+        from metrics import node_latency
+        from session import SessionManager
+
+        redis = fakeredis.FakeAsyncRedis()
+        app.session_store = SessionManager(redis=redis)
+
+        def receive_until(ws, done):
+            while True:
+                message = ws.receive()
+                text = message.get("text") or ""
+                if done(text):
+                    return text
+
+        def connect(client, token=None):
+            start = time.perf_counter()
+            with client.websocket_connect(f"/ws?session={token}" if token else "/ws") as ws:
+                session = json.loads(receive_until(ws, lambda text: '"type":"session"' in text))
+                if not token:
+                    receive_until(ws, lambda text: "Share your brief" in text)
+                # Until the client has something to show
+                elapsed = time.perf_counter() - start
+                if not token:
+                    ws.send_text("Product is kit kat, objective conversion, budget 20k, meta, 1 month")
+                    receive_until(ws, lambda text: '"stream_end"' in text or '"complex"' in text)
+            return session, elapsed
+
+        with TestClient(app.app) as client:
+            session, fresh = connect(client)
+            token = session["token"]
+            calls = fake_llm.calls
+            node_runs = sum(entry["count"] for key, entry in node_latency.summary().items() if key.endswith(".total"))
+
+            hot = []
+            for _ in range(args.reconnects):
+                session, elapsed = connect(client, token)
+                assert session["resumed"] and session["replay"]["table"], session
+                hot.append(elapsed)
+
+            # Another worker, or the session evicted: rehydrated from Redis
+            cold = []
+            for _ in range(args.reconnects):
+                app.session_store = SessionManager(redis=redis)
+                session, elapsed = connect(client, token)
+                assert session["resumed"], session
+                cold.append(elapsed)
+
+            assert fake_llm.calls == calls, f"{fake_llm.calls - calls} LLM calls while resuming"
+            assert node_runs == sum(
+                entry["count"] for key, entry in node_latency.summary().items() if key.endswith(".total")
+            ), "graph nodes ran while resuming"
+
+        print(f"New session, until the greeting: {fresh * 1000:.1f}ms")
+        report("resume, session in memory", hot)
+        report("resume, loaded from Redis", cold)
+        print(f"Replayed: {session['replay']['text'][:60]!r}... with {len(session['replay']['table']['rows'])} table rows; "
+              f"no LLM calls or node runs while resuming")
+
+
+def bench_coalesce(args) -> None:
+    """
+    N sessions asking for the same product at once: DB queries and LLM calls with and
+    without single-flight, and with the response cache off (LLM_CACHE_ENABLED=0)
+    """
+    from llm_gateway import GatewayChatModel, LLMGateway, llm_calls
+    from prefetch import fetch_product_table, product_lookups
+    from tools import search_cache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "catalog.db")
+        build_synthetic_catalog(db_path, args.rows)
+        dialogue_manager = load_agent(db_path, args.llm_latency)
+        fake_llm = dialogue_manager.llm
+        # Generous limits: this measures coalescing, not rate limiting
+        gateway = LLMGateway(requests_per_minute=1e6, tokens_per_minute=1e9, max_in_flight=1000)
+        workflow = dialogue_manager.create_workflow()
+
+        for label, enabled, cache in (
+            ("no coalescing", False, None),
+            ("single-flight", True, None),
+            # What dialogue_manager builds with the response cache disabled
+            ("cache off", True, False),
+        ):
+            product_lookups.enabled = llm_calls.enabled = enabled
+            dialogue_manager.llm = GatewayChatModel(model=fake_llm, gateway=gateway, cache=cache)
+
+            search_cache.clear()
+            misses = search_cache.stats()["misses"]
+            start = time.perf_counter()
+
+            async def lookups():
+                await asyncio.gather(*[fetch_product_table("kit kat") for _ in range(args.sessions)])
+
+            asyncio.run(lookups())
+            queries = search_cache.stats()["misses"] - misses
+            print(f"{label:<14} {args.sessions} concurrent lookups: {queries} DB queries "
+                  f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+            search_cache.clear()
+            calls = fake_llm.calls
+
+            async def sessions():
+                return await asyncio.gather(*[run_session(dialogue_manager, workflow) for _ in range(args.sessions)])
+
+            start = time.perf_counter()
+            asyncio.run(sessions())
+            made = fake_llm.calls - calls
+            print(f"{label:<14} {args.sessions} concurrent sessions: {made} LLM calls "
+                  f"in {(time.perf_counter() - start) * 1000:.1f}ms")
+            if enabled:
+                assert made < args.sessions, f"{label}: identical calls weren't coalesced"
+
+
+def start_stub_llm_server(rpm: int, latency: float):
+    """
+    Local stand-in for the Azure chat completions endpoint. Like Azure it
+    enforces the per-minute quota over 10 second windows, answering 429 with
+    retry-after once rpm / 6 requests arrived in the last 10 seconds.
+    Returns (endpoint, counters); the server runs in a daemon thread.
+    """
+    import socket
+    import threading
+    from collections import deque
+
+    import uvicorn
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse
+
+    counters = {"requests": 0, "ok": 0, "throttled": 0}
+    recent = deque()
+    stub = FastAPI()
+
+    @stub.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(deployment: str):
+        counters["requests"] += 1
+        now = time.monotonic()
+        while recent and recent[0] < now - 10:
+            recent.popleft()
+        if len(recent) >= rpm / 6:
+            counters["throttled"] += 1
+            retry_after = max(0.05, 10 - (now - recent[0]))
+            return JSONResponse(
+                {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                status_code=429, headers={"retry-after": f"{retry_after:.2f}"}
+            )
+        recent.append(now)
+        await asyncio.sleep(latency)
+        counters["ok"] += 1
+        return {
+            "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 5, "total_tokens": 55},
+        }
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(stub, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}", counters
+
+
+def bench_gateway(args) -> None:
+    """ A burst of LLM calls against a rate-limited stub, straight to the client vs through the gateway """
+    from langchain_core.messages import HumanMessage
+    from langchain_openai import AzureChatOpenAI
+    from llm_gateway import GatewayChatModel, LLMBusyError, LLMGateway, http_clients
+
+    for label, use_gateway in (("direct", False), ("gateway", True)):
+        endpoint, counters = start_stub_llm_server(args.stub_rpm, args.latency)
+        model = AzureChatOpenAI(
+            azure_deployment="gpt-4o", openai_api_version="2024-06-01", azure_endpoint=endpoint,
+            api_key="stub", temperature=0, max_retries=args.max_retries, **http_clients()
+        )
+
+        async def main():
+            llm = model
+            if use_gateway:
+                # A little under the stub's quota, like production settings
+                gateway = LLMGateway(
+                    requests_per_minute=args.stub_rpm * 0.9, max_in_flight=args.max_in_flight,
+                    queue_timeout=args.queue_timeout
+                )
+                llm = GatewayChatModel(model=model, gateway=gateway)
+
+            async def call(i):
+                start = time.perf_counter()
+                try:
+                    # Distinct prompts, or single-flight would fold them into one call
+                    await llm.ainvoke([HumanMessage(content=f"hello {i}")])
+                    return "ok", time.perf_counter() - start
+                except LLMBusyError:
+                    return "busy", time.perf_counter() - start
+                except Exception as e:
+                    return type(e).__name__, time.perf_counter() - start
+
+            return await asyncio.gather(*[call(i) for i in range(args.requests)])
+
+        results = asyncio.run(main())
+        outcomes = {}
+        for outcome, _ in results:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        report(f"{label}, {args.requests} calls", [elapsed for outcome, elapsed in results if outcome == "ok"] or [0])
+        print(f"  outcomes {outcomes}, stub saw {counters['requests']} requests, {counters['throttled']} answered 429")
+
+    check_token_quota(args.tpm, args.request_tokens, args.tpm_seconds)
+
+
+def check_token_quota(tokens_per_minute: float, request_tokens: int, seconds: float) -> None:
+    """ Requests bigger than the token bucket must still be held to tokens_per_minute """
+    from llm_gateway import LLMBusyError, LLMGateway
+
+    gateway = LLMGateway(
+        requests_per_minute=1e6, tokens_per_minute=tokens_per_minute, max_in_flight=1000, queue_timeout=seconds * 2
+    )
+    admitted = []
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+
+        async def caller():
+            while loop.time() - start < seconds:
+                try:
+                    await gateway.acquire(request_tokens)
+                except LLMBusyError:
+                    return
+                if loop.time() - start <= seconds:
+                    admitted.append(request_tokens)
+                gateway.release(request_tokens, request_tokens)
+
+        await asyncio.wait([asyncio.ensure_future(caller()) for _ in range(20)], timeout=seconds + 0.5)
+
+    asyncio.run(main())
+    # The first request goes straight through on a full bucket; after that it's all paid for at the refill rate
+    sustained = (sum(admitted) - request_tokens) * 60 / seconds
+    print(f"{request_tokens}-token requests for {seconds:.0f}s at {tokens_per_minute:,.0f} TPM: {len(admitted)} admitted, "
+          f"sustained {sustained:,.0f} tokens/min")
+    assert sustained <= tokens_per_minute, f"{sustained:,.0f} tokens/min is over the {tokens_per_minute:,.0f} quota"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search = subparsers.add_parser("search", help="product search latency, LIKE vs FTS5")
+    search.add_argument("--rows", type=int, default=2_000_000)
+    search.add_argument("--repeats", type=int, default=5)
+    search.set_defaults(func=bench_search)
+
+    pages = subparsers.add_parser("pages", help="time-to-first-row of paginated search")
+    pages.add_argument("--rows", type=int, default=2_000_000)
+    pages.add_argument("--results", type=int, default=2000)
+    pages.add_argument("--page-size", type=int, default=SEARCH_LIMIT)
+    pages.add_argument("--repeats", type=int, default=5)
+    pages.set_defaults(func=bench_pages)
+
+    fuzzy = subparsers.add_parser("fuzzy", help="trigram matcher build time, memory and latency")
+    fuzzy.add_argument("--rows", type=int, default=2_000_000)
+    fuzzy.add_argument("--repeats", type=int, default=5)
+    fuzzy.set_defaults(func=bench_fuzzy)
+
+    sessions = subparsers.add_parser("sessions", help="concurrent sessions through the workflow")
+    sessions.add_argument("--sessions", type=int, default=20)
+    sessions.add_argument("--rows", type=int, default=50_000)
+    sessions.add_argument("--llm-latency", type=float, default=0.3)
+    sessions.set_defaults(func=bench_sessions)
+
+    brief = subparsers.add_parser("brief", help="rule-based brief extraction accuracy and latency")
+    brief.add_argument("--repeats", type=int, default=200)
+    brief.add_argument("--llm-latency", type=float, default=1.5)
+    brief.set_defaults(func=bench_brief)
+
+    prompt = subparsers.add_parser("prompt", help="product table prompt size, full vs token budget")
+    prompt.add_argument("--rows", type=int, default=200_000)
+    prompt.add_argument("--categories", type=int, default=300)
+    prompt.add_argument("--limits", type=int, nargs="+", default=[50, 200, 1000, 5000])
+    prompt.add_argument("--budget", type=int, default=PROMPT_TABLE_TOKEN_BUDGET)
+    prompt.add_argument("--repeats", type=int, default=5)
+    prompt.add_argument("--llm-repeats", type=int, default=3)
+    prompt.add_argument("--llm-latency", type=float, default=0.3, help="stub LLM latency before prefill (s)")
+    prompt.add_argument("--seconds-per-1k-tokens", type=float, default=0.05, help="stub LLM prefill time per 1k prompt tokens")
+    prompt.add_argument("--price-per-1m-tokens", type=float, default=2.5, help="input price used for the cost column ($)")
+    prompt.set_defaults(func=bench_prompt)
+
+    history = subparsers.add_parser("history", help="per-turn latency over a long session")
+    history.add_argument("--turns", type=int, default=1000)
+    history.add_argument("--rows", type=int, default=20_000)
+    history.add_argument("--window", type=int, default=HISTORY_WINDOW_TURNS, help="turns kept verbatim, 0 keeps everything")
+    history.set_defaults(func=bench_history)
+
+    gateway = subparsers.add_parser("gateway", help="LLM calls against a rate-limited local stub server")
+    gateway.add_argument("--requests", type=int, default=100)
+    gateway.add_argument("--stub-rpm", type=int, default=300)
+    gateway.add_argument("--latency", type=float, default=0.2)
+    gateway.add_argument("--max-in-flight", type=int, default=16)
+    gateway.add_argument("--queue-timeout", type=float, default=LLM_QUEUE_TIMEOUT)
+    gateway.add_argument("--max-retries", type=int, default=2)
+    gateway.add_argument("--tpm", type=float, default=60_000, help="token quota for the throughput check")
+    gateway.add_argument("--request-tokens", type=int, default=5000)
+    gateway.add_argument("--tpm-seconds", type=float, default=10)
+    gateway.set_defaults(func=bench_gateway)
+
+    dispatch = subparsers.add_parser("dispatch", help="nodes run per turn, router vs replay")
+    dispatch.add_argument("--rows", type=int, default=5_000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    codec = subparsers.add_parser("codec", help="session state size and encode/decode time, JSON vs msgpack")
+    codec.add_argument("--turns", type=int, nargs="+", default=[5, 20, 50])
+    codec.add_argument("--rows", type=int, default=50_000)
+    codec.add_argument("--repeats", type=int, default=200)
+    codec.set_defaults(func=bench_codec)
+
+    store = subparsers.add_parser("store", help="Redis bytes written per turn, session deltas vs one blob")
+    store.add_argument("--turns", type=int, default=200)
+    store.add_argument("--redis-url", default=None, help="defaults to fakeredis")
+    store.set_defaults(func=bench_store)
+
+    resume = subparsers.add_parser("resume", help="reconnect latency with a session token")
+    resume.add_argument("--reconnects", type=int, default=50)
+    resume.add_argument("--rows", type=int, default=50_000)
+    resume.add_argument("--llm-latency", type=float, default=0.3)
+    resume.set_defaults(func=bench_resume)
+
+    coalesce = subparsers.add_parser("coalesce", help="identical concurrent lookups and LLM calls")
+    coalesce.add_argument("--sessions", type=int, default=50)
+    coalesce.add_argument("--rows", type=int, default=50_000)
+    coalesce.add_argument("--llm-latency", type=float, default=0.3)
+    coalesce.set_defaults(func=bench_coalesce)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
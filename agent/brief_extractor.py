@@ -0,0 +1,221 @@
+import re
+from typing import Dict, List, Optional, Tuple
+
+BRIEF_FIELDS = ["product_name", "objectives", "budget", "channel", "duration"]
+
+# Canonical objective for each phrasing; the first match in the clause wins
+OBJECTIVES = {
+    "conversion": "conversion", "conversions": "conversion", "convert": "conversion",
+    "sales": "sales", "sell": "sales", "purchase": "conversion", "purchases": "conversion",
+    "awareness": "awareness", "aware": "awareness",
+    "consideration": "consideration",
+    "reach": "reach",
+    "engagement": "engagement",
+    "trial": "trial",
+    "loyalty": "loyalty", "retention": "loyalty",
+    "acquisition": "acquisition",
+    "traffic": "traffic",
+}
+
+CHANNELS = {
+    "meta": "meta", "facebook": "meta", "fb": "meta", "instagram": "meta", "insta": "meta",
+    "tiktok": "tiktok", "tik tok": "tiktok",
+    "youtube": "youtube",
+    "google": "google", "paid search": "google", "ppc": "google",
+    "display": "display", "programmatic": "programmatic",
+    "pinterest": "pinterest", "snapchat": "snapchat",
+    "tv": "tv", "bvod": "bvod", "ctv": "ctv",
+    "email": "email", "crm": "email",
+    "in-store": "in-store", "instore": "in-store",
+    "social": "social", "online": "online", "digital": "digital",
+}
+
+CURRENCIES = {"£": "£", "$": "$", "€": "€", "gbp": "£", "pounds": "£", "usd": "$", "dollars": "$", "eur": "€", "euros": "€"}
+MULTIPLIERS = {"k": 1_000, "thousand": 1_000, "grand": 1_000, "m": 1_000_000, "mn": 1_000_000, "million": 1_000_000}
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+    "seven": 7, "eight": 8, "nine": 9, "ten": 10, "eleven": 11, "twelve": 12,
+}
+# Unit aliases to (canonical unit, multiplier)
+DURATION_UNITS = {
+    "day": ("day", 1), "days": ("day", 1),
+    "week": ("week", 1), "weeks": ("week", 1), "wk": ("week", 1), "wks": ("week", 1),
+    "month": ("month", 1), "months": ("month", 1), "mo": ("month", 1), "mos": ("month", 1),
+    "quarter": ("month", 3), "quarters": ("month", 3),
+    "year": ("year", 1), "years": ("year", 1), "yr": ("year", 1), "yrs": ("year", 1),
+}
+
+# A clause is a line, sentence or comma/semicolon separated part of one
+# (commas inside numbers like 30,000 don't split)
+CLAUSE_SPLIT = re.compile(r"[\n;]+|,(?!\d{3}\b)|\.(?:\s|$)")
+
+# "product is X", "brand: X", "the product for this campaign is X": a noun needs an explicit anchor.
+# "promote X": a verb is followed by the value directly, which must then read as a name
+PRODUCT_PATTERNS = [
+    re.compile(
+        r"\b(?:product(?:\s+name)?|brand)\b(?:\s+(?:for|of|in)\s+[^=:]+?)?\s*(?:\bis\b|=|:|-|\bwill be\b)\s*(?P<value>.+)",
+        re.IGNORECASE
+    ),
+    re.compile(r"\b(?:promoting|promote|advertising|advertise)\b\s*(?P<value>.+)", re.IGNORECASE),
+]
+# The product name ends at the first joining word; the rest of the clause is still read for other fields
+PRODUCT_END = re.compile(
+    r"\s+(?:and|with|for|to|on|in|at|via|across|through|over|during|next|this|from|because|so|but|which|that)\s+",
+    re.IGNORECASE
+)
+# A value starting with one of these is a reference, not a name ("promote it", "advertise our ...")
+PRODUCT_STOPWORDS = {
+    "it", "its", "this", "that", "these", "those", "them", "they", "our", "my", "your", "their",
+    "we", "us", "something", "anything", "some", "for", "of", "to", "on", "in", "with", "at",
+    "is", "are", "was", "will", "be", "and", "or", "campaign", "product", "brand",
+}
+OBJECTIVE_KEYWORDS = re.compile(r"\b(?:objectives?|goals?|aims?|kpis?|drive|driving|boost|build|increase|grow)\b", re.IGNORECASE)
+BUDGET_KEYWORDS = re.compile(r"\b(?:budget|spend|spending)\b", re.IGNORECASE)
+CHANNEL_KEYWORDS = re.compile(r"\b(?:channels?|platforms?|media|on|via|across|through)\b", re.IGNORECASE)
+DURATION_KEYWORDS = re.compile(r"\b(?:duration|run|runs|running|last|lasts|lasting|flight|for|over|during)\b", re.IGNORECASE)
+
+AMOUNT_PATTERN = re.compile(
+    r"(?P<prefix>[£$€])?\s*(?P<number>\d[\d,]*(?:\.\d+)?)\s*"
+    r"(?P<multiplier>k|thousand|grand|mn|m|million)?\b\s*"
+    r"(?P<suffix>gbp|usd|eur|pounds|dollars|euros)?\b",
+    re.IGNORECASE
+)
+DURATION_PATTERN = re.compile(
+    r"\b(?P<number>\d+|" + "|".join(NUMBER_WORDS) + r")[\s-]*"
+    r"(?P<unit>" + "|".join(sorted(DURATION_UNITS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+VOCAB_PATTERN = {
+    name: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(vocab, key=len, reverse=True)) + r")\b", re.IGNORECASE)
+    for name, vocab in (("objectives", OBJECTIVES), ("channel", CHANNELS))
+}
+
+# Words left over after the matched clauses that don't carry brief content
+FILLER_WORDS = {
+    "the", "a", "an", "and", "is", "are", "our", "my", "we", "i", "it", "will", "be", "to", "of",
+    "for", "with", "hi", "hello", "hey", "thanks", "thank", "you", "please", "here", "brief",
+    "campaign", "main", "on", "in", "s", "ok", "okay", "yes",
+}
+
+
+def _clauses(text: str) -> List[str]:
+    return [clause.strip() for clause in CLAUSE_SPLIT.split(text) if clause.strip()]
+
+
+def _vocabulary(field: str, vocab: Dict[str, str], clause: str) -> List[str]:
+    found = []
+    for match in VOCAB_PATTERN[field].finditer(clause):
+        canonical = vocab[match.group(0).lower()]
+        if canonical not in found:
+            found.append(canonical)
+    return found
+
+
+def parse_product(clause: str) -> Tuple[Optional[str], str]:
+    """
+    "promote Twix to drive awareness" -> ("Twix", "drive awareness").
+    The name is None when there's a product phrase but no usable name in it.
+    """
+    for pattern in PRODUCT_PATTERNS:
+        match = pattern.search(clause)
+        if not match:
+            continue
+        value, *rest = PRODUCT_END.split(match.group("value"), maxsplit=1)
+        value = re.sub(r"^(?:the|a|an)\s+", "", value.strip(" '\""), flags=re.IGNORECASE)
+        words = value.split()
+        if not words or words[0].lower() in PRODUCT_STOPWORDS:
+            return None, clause
+        return value, rest[0] if rest else ""
+    return None, clause
+
+
+def parse_budget(clause: str) -> Optional[str]:
+    """ "budget is 20k" -> "20,000", "£1.5m" -> "£1,500,000" """
+    for match in AMOUNT_PATTERN.finditer(clause):
+        number = float(match.group("number").replace(",", ""))
+        multiplier = MULTIPLIERS.get((match.group("multiplier") or "").lower(), 1)
+        currency = CURRENCIES.get(match.group("prefix") or (match.group("suffix") or "").lower(), "")
+        # A bare small number without currency or k/m is more likely a duration or quantity
+        if not currency and multiplier == 1 and number < 100:
+            continue
+        amount = number * multiplier
+        return f"{currency}{amount:,.0f}" if amount == int(amount) else f"{currency}{amount:,.2f}"
+    return None
+
+
+def parse_duration(clause: str) -> Optional[str]:
+    """ "campaign will run for 1 month" -> "1 month", "a quarter" -> "3 months" """
+    match = DURATION_PATTERN.search(clause)
+    if not match:
+        return None
+    number = match.group("number").lower()
+    count = int(number) if number.isdigit() else NUMBER_WORDS[number]
+    unit, factor = DURATION_UNITS[match.group("unit").lower()]
+    count *= factor
+    return f"{count} {unit}" if count == 1 else f"{count} {unit}s"
+
+
+def extract_brief(text: str) -> Tuple[Dict[str, str], str]:
+    """
+    Pull brief fields out of common phrasings with regexes and vocabularies.
+
+    Returns only the fields found with confidence, plus the text that wasn't
+    used by any of them, so the caller can tell whether the LLM has anything
+    left to read.
+    """
+    fields: Dict[str, str] = {}
+    # Objectives and channels are often listed across several clauses
+    lists: Dict[str, List[str]] = {"objectives": [], "channel": []}
+    leftover: List[str] = []
+
+    for clause in _clauses(text):
+        used = False
+        short = len(clause.split()) <= 3
+
+        # A product phrase whose name can't be read ("promote it on meta") goes to the LLM
+        # even if other fields are found in the clause
+        ambiguous = False
+        if "product_name" not in fields and any(pattern.search(clause) for pattern in PRODUCT_PATTERNS):
+            product, rest = parse_product(clause)
+            if product:
+                fields["product_name"] = product
+                clause = rest
+                used = True
+            else:
+                ambiguous = True
+
+        for field, vocab, keywords in (
+            ("objectives", OBJECTIVES, OBJECTIVE_KEYWORDS),
+            ("channel", CHANNELS, CHANNEL_KEYWORDS),
+        ):
+            found = _vocabulary(field, vocab, clause)
+            if found and (keywords.search(clause) or short):
+                lists[field] += [value for value in found if value not in lists[field]]
+                used = True
+
+        if "budget" not in fields and (BUDGET_KEYWORDS.search(clause) or re.search(r"[£$€]", clause)):
+            budget = parse_budget(clause)
+            if budget:
+                fields["budget"] = budget
+                used = True
+
+        if "duration" not in fields and (DURATION_KEYWORDS.search(clause) or short):
+            duration = parse_duration(clause)
+            if duration:
+                fields["duration"] = duration
+                used = True
+
+        if not used or ambiguous:
+            leftover.append(clause)
+
+    for field, values in lists.items():
+        if values:
+            fields[field] = ", ".join(values)
+
+    return {field: fields[field] for field in BRIEF_FIELDS if field in fields}, ", ".join(leftover)
+
+
+def has_content(text: str) -> bool:
+    """ Whether leftover text has anything beyond filler words worth sending to the LLM """
+    return any(word not in FILLER_WORDS for word in re.findall(r"[a-z0-9£$€]+", text.lower()))
@@ -0,0 +1,28 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Threads for blocking work (sqlite lookups, CPU-bound transforms) run from
+# async graph nodes, so it never stalls the uvicorn event loop
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """ Run a sync callable on the bounded pool and await its result """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+def blocking_pool_stats() -> dict:
+    return {
+        "max_workers": BLOCKING_POOL_SIZE,
+        "threads": len(_executor._threads),
+        "queued": _executor._work_queue.qsize(),
+    }
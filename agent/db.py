@@ -0,0 +1,255 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from search_index import catalog_signature, ensure_search_index, load_category_rollup
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "/home/azureuser/projects/whizzbang_audience/db/db.db")
+# Connections are read-only (mode=ro). A catalog refreshed in place is picked
+# up: when the file changes and the DIM_ITEMS signature with it, the search
+# index, category rollup and caches are rebuilt and connections reopened. DB_IMMUTABLE=1 tells sqlite the file never changes (no locking,
+# no change detection), which is faster but means the catalog is never refreshed.
+DB_IMMUTABLE = os.getenv("DB_IMMUTABLE", "0") == "1"
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_MAX_CONCURRENT = int(os.getenv("DB_MAX_CONCURRENT", "16"))
+# sqlite3 keeps this many prepared statements per connection, keyed on the SQL text
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "128"))
+# Optional query returning a single catalog version value, e.g.
+# "SELECT value FROM CATALOG_META WHERE key = 'version'". Part of the catalog
+# signature, so rows updated in place (same count and max rowid) are noticed.
+CATALOG_VERSION_QUERY = os.getenv("CATALOG_VERSION_QUERY", "")
+
+
+class ConnectionManager:
+    """
+    Long-lived read-only sqlite connections, one per thread.
+
+    At most max_concurrent threads can use their connection at the same time,
+    the rest wait (and are counted in stats["waits"]).
+    """
+
+    def __init__(
+        self,
+        db_path: str = DB_PATH,
+        immutable: bool = DB_IMMUTABLE,
+        mmap_size: int = DB_MMAP_SIZE,
+        max_concurrent: int = DB_MAX_CONCURRENT,
+        statement_cache: int = DB_STATEMENT_CACHE,
+    ):
+        self.db_path = db_path
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.max_concurrent = max_concurrent
+        self.statement_cache = statement_cache
+        self.search_index_ready = False
+        # (buyer category, product category) -> total SKUs in the catalog
+        self.category_rollup: Dict[Tuple[str, str], int] = {}
+
+        self._local = threading.local()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._prepared = False
+        self._refresh_lock = threading.Lock()
+        # Catalog signature the index and rollup were built from, and the file
+        # mtime it was last checked at; bumping the generation makes every
+        # thread reopen its connection
+        self._signature: Optional[str] = None
+        self._mtime: Optional[int] = None
+        self._generation = 0
+        # thread ident -> connection, so connections can be counted and closed
+        self._connections: Dict[int, sqlite3.Connection] = {}
+        self._stats = {"checkouts": 0, "waits": 0, "opened": 0}
+
+    def _uri(self) -> str:
+        uri = f"file:{self.db_path}?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        return uri
+
+    def prepare(self) -> None:
+        """
+        Build or refresh the search index and load the category rollup once,
+        before any read-only connection is opened. An immutable connection
+        would never see the index change afterwards.
+        """
+        with self._lock:
+            if self._prepared:
+                return
+            self._build(recheck=False)
+            self._prepared = True
+
+    def _build(self, recheck: bool) -> None:
+        """
+        Bring the index up to date and load the rollup. The index is rebuilt
+        only when its stored signature differs from the catalog's, so a
+        worker that finds another one already rebuilt it does nothing.
+        """
+        try:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=rw", uri=True)
+        except sqlite3.Error as e:
+            # Read-only catalog, use the index only if it was built elsewhere
+            print(f"Opening {self.db_path} read-write failed ({e}), checking existing search index")
+            conn = sqlite3.connect(self._uri(), uri=True)
+
+        try:
+            self.search_index_ready = ensure_search_index(
+                conn, self.db_path, recheck=recheck, version_query=CATALOG_VERSION_QUERY
+            )
+            self.category_rollup = load_category_rollup(conn)
+            print(f"Loaded SKU counts for {len(self.category_rollup)} categories")
+            self._signature = catalog_signature(conn, CATALOG_VERSION_QUERY)
+        finally:
+            conn.close()
+        # Taken after the index writes, so they don't count as a catalog change
+        self._mtime = self._read_mtime()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self._uri(),
+            uri=True,
+            check_same_thread=False,  # only used by its own thread, but close_all() runs elsewhere
+            cached_statements=self.statement_cache,
+        )
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA query_only = 1")
+
+        with self._lock:
+            alive = {thread.ident for thread in threading.enumerate()}
+            for ident in [ident for ident in self._connections if ident not in alive]:
+                self._connections.pop(ident).close()
+            self._connections[threading.get_ident()] = conn
+            self._stats["opened"] += 1
+
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """ Check out this thread's connection """
+        self.prepare()
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            self._slots.acquire()
+
+        try:
+            conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+            if conn is not None and getattr(self._local, "generation", None) != self._generation:
+                # Opened before a catalog refresh
+                with self._lock:
+                    self._connections.pop(threading.get_ident(), None)
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self._open()
+                self._local.conn = conn
+                self._local.generation = self._generation
+            with self._lock:
+                self._stats["checkouts"] += 1
+            yield conn
+        finally:
+            self._slots.release()
+
+    def _read_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.db_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def catalog_version(self) -> str:
+        """
+        Signature of the DIM_ITEMS rows, which changes when the catalog is
+        refreshed. A change rebuilds the search index and category rollup and
+        reopens connections before the new signature is returned, so callers
+        keying caches on it never mix old and new catalog data.
+
+        The signature is only recomputed when the file's mtime moves, and the
+        index's own writes (here or in another worker) don't change it. While
+        one thread refreshes, the others keep serving the previous catalog.
+
+        In immutable mode sqlite assumes the file never changes, so there is
+        nothing to check and the signature is fixed.
+        """
+        self.prepare()
+        if not self.immutable and self._read_mtime() != self._mtime:
+            self._refresh()
+        return self._signature
+
+    def _refresh(self) -> None:
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            mtime = self._read_mtime()
+            if mtime == self._mtime:
+                # Another thread refreshed first
+                return
+            try:
+                conn = sqlite3.connect(self._uri(), uri=True)
+                try:
+                    signature = catalog_signature(conn, CATALOG_VERSION_QUERY)
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                print(f"Could not read catalog signature: {e}")
+                return
+
+            if signature == self._signature:
+                # File touched without changing DIM_ITEMS, e.g. another worker's index build
+                self._mtime = mtime
+                return
+
+            print(f"Catalog {self.db_path} changed, updating search index and category rollup")
+            self._build(recheck=True)
+            with self._lock:
+                self._generation += 1
+        finally:
+            self._refresh_lock.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                **self._stats,
+                "open_connections": len(self._connections),
+                "max_concurrent": self.max_concurrent,
+                "db_path": self.db_path,
+                "search_index_ready": self.search_index_ready,
+                "categories": len(self.category_rollup),
+            }
+
+    def close_all(self) -> None:
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+            # connections cached in other threads' locals are now closed,
+            # so hand every thread a fresh one next time
+            self._local = threading.local()
+            self._prepared = False
+
+
+_manager: Optional[ConnectionManager] = None
+_manager_lock = threading.Lock()
+
+
+def get_connection_manager() -> ConnectionManager:
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ConnectionManager()
+        return _manager
+
+
+def configure_database(**kwargs) -> ConnectionManager:
+    """ Swap the shared manager, e.g. configure_database(db_path="test.db", immutable=False) """
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close_all()
+        _manager = ConnectionManager(**kwargs)
+        return _manager
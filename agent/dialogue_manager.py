@@ -6,10 +6,16 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from langchain_core.output_parsers import PydanticOutputParser
 from langchain_openai import AzureChatOpenAI
-from pydantic import BaseModel
+from pydantic import BaseModel, create_model
 
 from schema import AudienceBuilderState, ProductSearchResults
-from tools import ProductLookupTool, transform_to_product_table
+from tools import transform_to_product_table
+from greetings import GreetingPool
+from llm_cache import llm_cache, uncached
+from llm_gateway import GatewayChatModel, LLMBusyError, llm_gateway, http_clients, LLM_MAX_RETRIES
+from brief_extractor import extract_brief, has_content
+from prefetch import product_prefetcher, fetch_product_table
+from prompt_budget import build_table_prompt, count_tokens
 
 from pprint import pprint
 
@@ -20,14 +26,29 @@ END_POINT = os.getenv("END_POINT")
 DEPLOYMENT_NAME = "gpt-4o"
 API_VERSION_GPT = os.getenv("API_VERSION_GPT")
 
-llm = AzureChatOpenAI(
-    azure_deployment=DEPLOYMENT_NAME,
-    openai_api_version=API_VERSION_GPT,
-    azure_endpoint=END_POINT,
-    api_key=AZURE_OAI_KEY,
-    temperature=0
+# Every call goes through the shared gateway (rate limits, in-flight cap, queueing)
+# over pooled HTTP connections
+llm = GatewayChatModel(
+    model=AzureChatOpenAI(
+        azure_deployment=DEPLOYMENT_NAME,
+        openai_api_version=API_VERSION_GPT,
+        azure_endpoint=END_POINT,
+        api_key=AZURE_OAI_KEY,
+        temperature=0,
+        max_retries=LLM_MAX_RETRIES,
+        **http_clients()
+    ),
+    gateway=llm_gateway,
+    # Shared response cache; chains opt out with uncached(llm)
+    cache=llm_cache if llm_cache is not None else False
 )
 
+# "router" starts each turn at state["current_node"]; "replay" is the old fixed
+# greet -> gather_marketing_brief -> get_product_table path on every turn
+WORKFLOW_DISPATCH = os.getenv("WORKFLOW_DISPATCH", "router")
+
+BUSY_REPLY = "We're handling a lot of requests right now. Please send that again in a moment."
+
 
 class MarketingBrief(BaseModel):
     product_name: str
@@ -36,38 +57,55 @@ class MarketingBrief(BaseModel):
     channel: str
     duration: str
 
-def greet(state: AudienceBuilderState) -> AudienceBuilderState:
-    print(f"\n\nGreeting user from state: {state}")
-    
-    if state["conversation_history"]:
-        return {**state, "current_node": END}
-
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="""You are an audience-building assistant for Pollen.
+GREETING_PROMPT = """You are an audience-building assistant for Pollen.
         Greet the Abhinav warmly.
         
         Use 'some' emojis, but don't overdo it or be too cheesy. Use some bold for emphasis.
 
         Then **ask for a brief** (product name, objectives, budget, channel, duration) with a super short explanation of each,
-        so we can get started building the best possible audience.""")
+        so we can get started building the best possible audience."""
+
+# The greeting has no variables, so a handful are generated up front and rotated
+# instead of calling the LLM on every connection
+GREETING_TEMPERATURE = 0.9
+greeting_pool = GreetingPool(prompt=f"{DEPLOYMENT_NAME}:{GREETING_TEMPERATURE}:{GREETING_PROMPT}")
+
+async def generate_greeting() -> str:
+    prompt = ChatPromptTemplate.from_messages([
+        SystemMessage(content=GREETING_PROMPT)
     ])
 
-    chain = prompt | llm
-    response = chain.invoke({})
+    # A bit of temperature so the pooled greetings aren't all identical,
+    # and no response cache or every greeting would be the first one
+    chain = prompt | uncached(llm).bind(temperature=GREETING_TEMPERATURE)
+    response = await chain.ainvoke({})
+    return response.content
+
+async def greet(state: AudienceBuilderState) -> AudienceBuilderState:
+    print(f"\n\nGreeting user, {len(state['conversation_history'])} messages in history")
+    
+    if state["conversation_history"]:
+        return {"current_node": END}
+
+    greeting = greeting_pool.next()
+    if greeting is None:
+        # Cold pool: generate this one inline and fill the rest in the background
+        greeting = await generate_greeting()
+        greeting_pool.add(greeting)
+        greeting_pool.ensure_filling(generate_greeting)
 
     return {
-        **state,
-        "conversation_history": state["conversation_history"] + [
-            AIMessage(content=response.content)
+        "conversation_history": [
+            AIMessage(content=greeting)
         ],
         "current_node": "gather_marketing_brief"
     }
 
-def gather_marketing_brief(state: AudienceBuilderState) -> AudienceBuilderState:
-    print(f"\n\nCapturing marketing brief from user. State: {state}")
+async def gather_marketing_brief(state: AudienceBuilderState) -> AudienceBuilderState:
+    print(f"\n\nCapturing marketing brief from user. Brief so far: {state.get('brief_data')}")
 
     # 1) If we don't already have a 'brief' in state, store a dict with empty strings:
-    brief_data = state.get("brief_data", {
+    brief_data = dict(state.get("brief_data") or {
         "product_name": "",
         "objectives": "",
         "budget": "",
@@ -86,65 +124,99 @@ def gather_marketing_brief(state: AudienceBuilderState) -> AudienceBuilderState:
     # If no user message yet, politely ask for any marketing brief info
     if not last_user_message:
         return {
-            **state,
-            "conversation_history": state["conversation_history"] + [
+            "conversation_history": [
                 AIMessage(content="Could you share your Marketing Brief? (Product, Objectives, Budget, Channel, Duration)")
             ],
             "current_node": "gather_marketing_brief"
         }
 
-    # 3) Use the Pydantic parser to try to extract whatever fields are present
-    parser = PydanticOutputParser(pydantic_object=MarketingBrief)
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content="""Extract these fields if present:
-- product_name
-- objectives
-- budget
-- channel
-- duration
+    previous_brief = dict(brief_data)
+    previous_product = brief_data["product_name"]
+
+    # 3) Rules first: structured briefs ("budget is 20k", "channel is meta") are
+    #    parsed locally and don't need the LLM at all
+    extracted, leftover = extract_brief(last_user_message)
+    brief_data.update(extracted)
+
+    # 4) Fall back to the LLM only for fields still empty, and only if the rules
+    #    left part of the message unread
+    llm_fields = [k for k, v in brief_data.items() if not v.strip()]
+    if llm_fields and has_content(leftover):
+        parser = PydanticOutputParser(pydantic_object=create_model(
+            "PartialMarketingBrief", **{field: (MarketingBrief.model_fields[field].annotation, ...) for field in llm_fields}
+        ))
+        field_list = "\n".join(f"- {field}" for field in llm_fields)
+        prompt = ChatPromptTemplate.from_messages([
+            SystemMessage(content=f"""Extract these fields if present:
+{field_list}
 
 For missing ones, just fill with a short placeholder. 
 """),
-        HumanMessage(content=f"{last_user_message}\n\n{parser.get_format_instructions()}")
-    ])
+            HumanMessage(content=f"{last_user_message}\n\n{parser.get_format_instructions()}")
+        ])
+
+        chain = prompt | llm | parser
+
+        try:
+            parsed_brief = await chain.ainvoke({})
+        except LLMBusyError:
+            return {
+                "brief_data": brief_data,
+                "conversation_history": [AIMessage(content=BUSY_REPLY)],
+                "current_node": "gather_marketing_brief"
+            }
+        except Exception:
+            parsed_brief = None
+
+        if parsed_brief is None and not extracted:
+            # If we can't parse, just ask the user again
+            return {
+                "conversation_history": [
+                    AIMessage(content="I wasn't able to understand your details. Could you restate your brief, please?")
+                ],
+                "current_node": "gather_marketing_brief"
+            }
+
+        # Update partial data with newly parsed fields (ignore placeholders)
+        for field in llm_fields if parsed_brief is not None else []:
+            value = getattr(parsed_brief, field)
+            if value and "placeholder" not in value.lower():
+                brief_data[field] = value
+
+    # Start the product search now so it's ready by the time the brief is complete;
+    # a changed product name drops this session's hold on the old lookup, if it still has one
+    updates = {}
+    if brief_data["product_name"] != previous_product:
+        if previous_product and state.get("prefetched_product") == previous_product:
+            product_prefetcher.cancel(previous_product)
+        updates["prefetched_product"] = None
+        if brief_data["product_name"]:
+            product_prefetcher.start(brief_data["product_name"])
+            updates["prefetched_product"] = brief_data["product_name"]
 
-    chain = prompt | llm | parser
-    
-    try:
-        parsed_brief = chain.invoke({})  # a MarketingBrief instance
-    except Exception:
-        # If we can't parse, just ask the user again
+    # 5) Check if all fields are now filled
+    missing_fields = [k for k, v in brief_data.items() if not v.strip()]
+
+    if not missing_fields and brief_data == previous_brief and state.get("product_search_results"):
+        # Nothing changed since the recommendation was made, don't make it again
         return {
-            **state,
-            "conversation_history": state["conversation_history"] + [
-                AIMessage(content="I wasn't able to understand your details. Could you restate your brief, please?")
+            "conversation_history": [
+                AIMessage(content=(
+                    "Your brief is unchanged, so my recommendation above still stands. "
+                    "Tell me what you'd like to change (product, objectives, budget, channel or duration) "
+                    "and I'll take another look."
+                ))
             ],
-            "current_node": "gather_marketing_brief"
+            "current_node": END
         }
 
-    # 4) Update partial data with newly parsed fields (ignore placeholders)
-    #    For any field that's missing, we'll keep our existing data.
-    if parsed_brief.product_name and "placeholder" not in parsed_brief.product_name.lower():
-        brief_data["product_name"] = parsed_brief.product_name
-    if parsed_brief.objectives and "placeholder" not in parsed_brief.objectives.lower():
-        brief_data["objectives"] = parsed_brief.objectives
-    if parsed_brief.budget and "placeholder" not in parsed_brief.budget.lower():
-        brief_data["budget"] = parsed_brief.budget
-    if parsed_brief.channel and "placeholder" not in parsed_brief.channel.lower():
-        brief_data["channel"] = parsed_brief.channel
-    if parsed_brief.duration and "placeholder" not in parsed_brief.duration.lower():
-        brief_data["duration"] = parsed_brief.duration
-
-    # 5) Check if all fields are now filled
-    missing_fields = [k for k, v in brief_data.items() if not v.strip()]
-
     if missing_fields:
         # 6) We still need some data. Ask for the missing fields. Remain on the same node.
         missing_str = ", ".join(missing_fields)
         return {
-            **state,
+            **updates,
             "brief_data": brief_data,  # store partial
-            "conversation_history": state["conversation_history"] + [
+            "conversation_history": [
                 AIMessage(content=(
                     f"I still need the following info: {missing_str}.\n"
                     "Please provide them now. You can list them all together."
@@ -153,15 +225,19 @@ For missing ones, just fill with a short placeholder.
             "current_node": "gather_marketing_brief"
         }
 
+    if brief_data["product_name"] != previous_product:
+        # Results for the old product would otherwise be reused by get_product_table
+        updates["product_search_results"] = None
+
     return {
-        **state,
+        **updates,
         "brief_data": brief_data,  # for reference
         "product_name": brief_data["product_name"],
         "marketing_objectives": brief_data["objectives"],
         "marketing_budget": brief_data["budget"],
         "marketing_channel": brief_data["channel"],
         "marketing_duration": brief_data["duration"],
-        "conversation_history": state["conversation_history"] + [
+        "conversation_history": [
             AIMessage(content=(
                 f"Great, we have all the details now:\n\n"
                 f"• **Product**: {brief_data['product_name']}\n"
@@ -175,22 +251,7 @@ For missing ones, just fill with a short placeholder.
         "current_node": "get_product_table"
     }
 
-def get_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
-    print("\n\nFormatting Search Results")
-    
-    product_name = state.get("product_name")
-
-    try:
-        product_search_results = state.get("product_search_results")
-        if not product_search_results:
-            product_lookup_tool = ProductLookupTool()
-            product_search_results = product_lookup_tool.invoke(product_name)
-            state = {**state, "product_search_results": product_search_results}
-        
-        product_table = transform_to_product_table(product_search_results)
-        state = {**state, "product_table": product_table}
-        
-        response_prompt = ChatPromptTemplate.from_template("""
+PRODUCT_TABLE_PROMPT = """
         You have been presented with the users marketing brief query, for Audience Building.
 
         Marketing Objective: Conversion                                                   
@@ -208,41 +269,69 @@ def get_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
         Use 'some' emojis, but don't overdo it or be too cheesy. Use some bold for emphasis. Add some space for your sentences.
                                                             
         Do NOT produce an actual table in the text. We'll display it separately.
-        """)
-        
-        table_details = []
-        for row in product_table["rows"]:
-            sku_samples = ", ".join([f"{s['name']} (SKU: {s['sku']})" for s in row["skus"]])
-            table_details.append(
-                f"- {row['buyer_category']} > {row['product_category']}:\n"
-                f"  * Sample SKUs: {sku_samples}\n"
-                f"  * Total SKUs: {row['count']}"
-            )
+        """
+
+async def get_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
+    print("\n\nFormatting Search Results")
+    
+    product_name = state.get("product_name")
+
+    # take() releases this session's hold on the prefetched lookup
+    updates = {"prefetched_product": None}
+    try:
+        product_search_results = state.get("product_search_results")
+        if product_search_results:
+            product_table = transform_to_product_table(product_search_results)
+        else:
+            # Usually already fetched in the background while the brief was collected
+            prefetched = None
+            if state.get("prefetched_product") == product_name:
+                prefetched = await product_prefetcher.take(product_name)
+            if prefetched is None:
+                prefetched = await fetch_product_table(product_name)
+            product_search_results, product_table = prefetched
+
+        updates = {**updates, "product_search_results": product_search_results, "product_table": product_table}
         
-        response_chain = response_prompt | llm
-        response = response_chain.invoke({
-            "query": product_name,
-            "buyer_categories": ", ".join(product_search_results.unique_buyer_categories),
-            "product_categories": ", ".join(product_search_results.unique_product_categories),
-            "total_results": product_search_results.total_results,
-            "table_data": "\n\n".join(table_details)
-        })
+        # Rows are ranked and trimmed to PROMPT_TABLE_TOKEN_BUDGET, so the prompt
+        # stays the same size however many results the search returned
+        table_prompt = build_table_prompt(product_table)
+        response_prompt = ChatPromptTemplate.from_template(PRODUCT_TABLE_PROMPT)
+        prompt_value = response_prompt.format_prompt(
+            query=product_name,
+            buyer_categories=table_prompt["buyer_categories"],
+            product_categories=table_prompt["product_categories"],
+            total_results=product_search_results.total_matches or product_search_results.total_results,
+            table_data=table_prompt["table_data"]
+        )
+        print(
+            f"Product table prompt: {count_tokens(prompt_value.to_string())} tokens, "
+            f"{table_prompt['rows_included']}/{table_prompt['rows_total']} rows"
+        )
+
+        response = await llm.ainvoke(prompt_value)
 
         content = response.content if hasattr(response, 'content') else response
 
         return {
-            **state,
-            "conversation_history": state["conversation_history"] + [
+            **updates,
+            "conversation_history": [
                 AIMessage(content=content)
             ],
             "current_node": END
         }
         
+    except LLMBusyError:
+        return {
+            **updates,
+            "conversation_history": [AIMessage(content=BUSY_REPLY)],
+            "current_node": END
+        }
     except Exception as e:
         print(f"Error in get_product_table: {e}")
         return {
-            **state,
-            "conversation_history": state["conversation_history"] + [
+            **updates,
+            "conversation_history": [
                 AIMessage(content=f"I encountered an error retrieving product details: {str(e)}")
             ],
             "current_node": END
@@ -251,12 +340,17 @@ def get_product_table(state: AudienceBuilderState) -> AudienceBuilderState:
 def get_initial_state():
     return {
         "conversation_history": [],
+        "conversation_summary": None,
+        "folded_turns": 0,
+        "folded_messages": 0,
         "product_name": None,
         "product_category": None,
         "buyer_category": None,
         "product_search_results": None,
         "product_table": None,
         "audience_selections": None,
+        "brief_data": None,
+        "prefetched_product": None,
         "marketing_objectives": None,
         "marketing_budget": None,
         "marketing_channel": None,
@@ -265,18 +359,39 @@ def get_initial_state():
     }
 
 
-def create_workflow():
+def route_turn(state: AudienceBuilderState) -> str:
+    """ Entry for a turn: resume at the node the last turn left off at """
+    node = state.get("current_node")
+    # A finished conversation goes back to the brief, so it can be changed
+    return "gather_marketing_brief" if node in (None, END) else node
+
+
+def route_after_brief(state: AudienceBuilderState) -> str:
+    """ Go on to the product table only once the brief is complete """
+    return "get_product_table" if state["current_node"] == "get_product_table" else END
+
+
+def create_workflow(dispatch: str = WORKFLOW_DISPATCH):
     workflow = StateGraph(AudienceBuilderState)
     
     workflow.add_node("greet", greet)
     workflow.add_node("gather_marketing_brief", gather_marketing_brief)
     workflow.add_node("get_product_table", get_product_table)
 
-    # Flow: greet -> gather_marketing_brief -> get_product_table -> END
-    workflow.add_edge("greet", "gather_marketing_brief")
-    workflow.add_edge("gather_marketing_brief", "get_product_table")
+    if dispatch == "replay":
+        # Flow: greet -> gather_marketing_brief -> get_product_table -> END
+        workflow.add_edge("greet", "gather_marketing_brief")
+        workflow.add_edge("gather_marketing_brief", "get_product_table")
+        workflow.add_edge("get_product_table", END)
+
+        workflow.set_entry_point("greet")
+        return workflow.compile()
+
+    # Each turn runs only what it needs: the greeting, one brief step, or the
+    # brief step that completes it followed by the product table
+    workflow.set_conditional_entry_point(route_turn, ["greet", "gather_marketing_brief", "get_product_table"])
+    workflow.add_edge("greet", END)
+    workflow.add_conditional_edges("gather_marketing_brief", route_after_brief, ["get_product_table", END])
     workflow.add_edge("get_product_table", END)
 
-    workflow.set_entry_point("greet")
-    
-    return workflow.compile()
\ No newline at end of file
+    return workflow.compile()
@@ -0,0 +1,175 @@
+import re
+import sqlite3
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# Typo-tolerant product matching on character trigrams of skuName.
+# Names are lowercased and stripped of spaces/punctuation first, so
+# "kitkat", "Kit-Kat" and "KIT KAT" all end up as "kitkat".
+
+FUZZY_MIN_SCORE = 0.2
+
+CATALOG_QUERY = """
+SELECT rowid, skuName
+FROM DIM_ITEMS
+WHERE skuName IS NOT NULL
+    AND catLevel4Name != 'NOT IN USE'
+    AND catLevel5Name != 'NOT IN USE'
+"""
+
+# Details of the matched rows, fetched after scoring so the matcher only has to hold rowids
+ROWS_QUERY = """
+SELECT rowid, skuId, skuName, catLevel4Name, catLevel5Name
+FROM DIM_ITEMS
+WHERE rowid IN ({placeholders})
+"""
+
+_NON_WORD = re.compile(r"[\W_]+")
+# Separates names in the concatenated buffer, and doubles as the
+# start/end-of-name marker inside trigrams
+_SEP = "\x00"
+
+
+def normalize_name(name: str) -> str:
+    return _NON_WORD.sub("", name.lower())
+
+
+def _trigram_codes(names: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return (doc ids, trigram codes) for every trigram of every name, computed
+    on one concatenated byte buffer instead of looping over names.
+    """
+    # normalize_name also strips any stray separator characters
+    text = _SEP + _SEP.join(normalize_name(name) for name in names) + _SEP
+    buf = np.frombuffer(text.encode("utf-8"), dtype=np.uint8).astype(np.int32)
+
+    if len(buf) < 3:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+
+    first, middle, last = buf[:-2], buf[1:-1], buf[2:]
+    codes = (first << 16) | (middle << 8) | last
+
+    # Name index of each position: how many separators came before it
+    doc_ids = np.cumsum(buf == 0)[:-2] - 1
+
+    # A separator in the middle means the trigram spans two names
+    keep = middle != 0
+    return doc_ids[keep].astype(np.int64), codes[keep]
+
+
+class TrigramMatcher:
+    """
+    TF-IDF weighted character-trigram vectors for every SKU name, scored
+    against the query by cosine similarity. Only the DIM_ITEMS rowid of each
+    name is kept; fetch_rows() looks up the details of the matches.
+    """
+
+    def __init__(self, rowids: np.ndarray, names: List[str]):
+        self.rowids = np.asarray(rowids, dtype=np.int64)
+
+        doc_ids, codes = _trigram_codes(names)
+        # Vocabulary is the sorted unique trigram codes; searchsorted maps codes to columns
+        self.vocab, columns = np.unique(codes, return_inverse=True)
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(codes), dtype=np.float32), (doc_ids, columns)),
+            shape=(len(self.rowids), len(self.vocab)),
+        )
+        matrix.sum_duplicates()
+
+        doc_freq = np.bincount(matrix.indices, minlength=len(self.vocab))
+        self.idf = np.log((1 + len(self.rowids)) / (1 + doc_freq)).astype(np.float32) + 1
+
+        matrix = matrix.multiply(self.idf).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        # Rows are unit length, so the dot product with a unit query is the cosine
+        self.matrix = sparse.csc_matrix(sparse.diags(1 / norms).dot(matrix), dtype=np.float32)
+
+    @classmethod
+    def from_connection(cls, conn: sqlite3.Connection) -> "TrigramMatcher":
+        rowids, names = [], []
+        for rowid, name in conn.execute(CATALOG_QUERY):
+            rowids.append(rowid)
+            names.append(name)
+        return cls(np.array(rowids, dtype=np.int64), names)
+
+    def __len__(self) -> int:
+        return len(self.rowids)
+
+    def _query_vector(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        _, codes = _trigram_codes([query])
+        codes, counts = np.unique(codes, return_counts=True)
+
+        columns = np.searchsorted(self.vocab, codes)
+        columns = np.clip(columns, 0, max(len(self.vocab) - 1, 0))
+        known = (self.vocab[columns] == codes) if len(self.vocab) else np.zeros(len(codes), dtype=bool)
+
+        # Unknown trigrams still count towards the query norm, which lowers the score
+        weights = counts.astype(np.float32) * np.where(known, self.idf[columns], self.idf.max(initial=1))
+        norm = np.sqrt((weights ** 2).sum()) or 1
+        return columns[known], weights[known] / norm
+
+    def search(self, query: str, k: int = 50, min_score: float = FUZZY_MIN_SCORE) -> List[Tuple[int, float]]:
+        """ Top-k (DIM_ITEMS rowid, score) pairs, best first """
+        columns, weights = self._query_vector(query)
+        if not len(columns):
+            return []
+
+        scores = self.matrix[:, columns] @ weights
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(int(self.rowids[i]), float(scores[i])) for i in top if scores[i] > 0 and scores[i] >= min_score]
+
+    def memory_bytes(self) -> int:
+        """ Everything the matcher holds: the matrix, vocabulary, idf weights and rowids """
+        return (
+            self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+            + self.vocab.nbytes + self.idf.nbytes + self.rowids.nbytes
+        )
+
+
+def fetch_rows(conn: sqlite3.Connection, rowids: List[int]) -> List[Tuple]:
+    """ (skuId, skuName, catLevel4Name, catLevel5Name) for each rowid, in the order given """
+    if not rowids:
+        return []
+    found = {
+        row[0]: row[1:]
+        for row in conn.execute(ROWS_QUERY.format(placeholders=", ".join("?" * len(rowids))), rowids)
+    }
+    return [found[rowid] for rowid in rowids if rowid in found]
+
+
+# db_path -> (catalog version, matcher)
+_matchers: Dict[str, Tuple[tuple, TrigramMatcher]] = {}
+# Guards the two dicts only; building holds the lock for that database
+_matchers_lock = threading.Lock()
+_build_locks: Dict[str, threading.Lock] = {}
+
+
+def get_matcher(db) -> TrigramMatcher:
+    """ Build (once per database and catalog version) the matcher for a ConnectionManager's catalog """
+    version = db.catalog_version()
+    with _matchers_lock:
+        entry = _matchers.get(db.db_path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        build_lock = _build_locks.setdefault(db.db_path, threading.Lock())
+
+    with build_lock:
+        # Someone else may have built it while this thread waited
+        entry = _matchers.get(db.db_path)
+        if entry is None or entry[0] != version:
+            print(f"Building trigram matcher for {db.db_path}")
+            with db.connection() as conn:
+                matcher = TrigramMatcher.from_connection(conn)
+            print(f"Trigram matcher ready: {len(matcher)} SKUs, {matcher.memory_bytes() / 1e6:.1f}MB")
+            entry = (version, matcher)
+            with _matchers_lock:
+                _matchers[db.db_path] = entry
+        return entry[1]
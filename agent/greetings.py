@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import Awaitable, Callable, List, Optional
+
+from dotenv import load_dotenv
+
+from concurrency import run_blocking
+
+load_dotenv()
+
+GREETING_POOL_SIZE = int(os.getenv("GREETING_POOL_SIZE", "6"))
+# Next to this module by default, wherever the server is started from
+GREETING_CACHE_PATH = os.getenv("GREETING_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "greetings.json"))
+
+
+class GreetingPool:
+    """
+    A small rotating pool of pre-generated greetings, persisted to disk.
+
+    The pool is tied to a hash of the prompt that produced it; if the prompt
+    text changes, the saved greetings are discarded and regenerated.
+    """
+
+    def __init__(self, prompt: str, size: int = GREETING_POOL_SIZE, path: str = GREETING_CACHE_PATH):
+        self.prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        self.size = size
+        self.path = path
+        self.greetings: List[str] = []
+        self._next = 0
+        self._lock = threading.Lock()
+        self._filling: Optional[asyncio.Task] = None
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if saved.get("prompt_hash") == self.prompt_hash:
+            self.greetings = saved.get("greetings", [])[:self.size]
+            print(f"Loaded {len(self.greetings)} greetings from {self.path}")
+        else:
+            print(f"Greeting prompt changed, discarding {self.path}")
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"prompt_hash": self.prompt_hash, "greetings": list(self.greetings)}, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def full(self) -> bool:
+        return len(self.greetings) >= self.size
+
+    def next(self) -> Optional[str]:
+        """ Next greeting in rotation, or None if the pool is still empty """
+        with self._lock:
+            if not self.greetings:
+                return None
+            greeting = self.greetings[self._next % len(self.greetings)]
+            self._next += 1
+            return greeting
+
+    def add(self, greeting: str) -> None:
+        with self._lock:
+            if greeting and greeting not in self.greetings and not self.full:
+                self.greetings.append(greeting)
+
+    async def fill(self, generate: Callable[[], Awaitable[str]]) -> None:
+        """ Generate greetings until the pool is full, then save it """
+        missing = self.size - len(self.greetings)
+        if missing <= 0:
+            return
+
+        print(f"Generating {missing} greetings")
+        results = await asyncio.gather(*[generate() for _ in range(missing)], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Greeting generation failed: {result}")
+            else:
+                self.add(result)
+
+        await run_blocking(self._save)
+
+    def ensure_filling(self, generate: Callable[[], Awaitable[str]]) -> None:
+        """ Start filling the pool in the background, unless it's full or already filling """
+        if self.full or (self._filling and not self._filling.done()):
+            return
+        self._filling = asyncio.create_task(self.fill(generate))
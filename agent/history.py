@@ -0,0 +1,131 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+from langchain_core.messages import HumanMessage
+
+load_dotenv()
+
+# Keep the last K user turns verbatim, fold older ones into conversation_summary.
+# Compaction runs once the window is exceeded by HISTORY_COMPACT_SLACK turns,
+# so its cost is paid every few turns rather than on every one. 0 disables it.
+HISTORY_WINDOW_TURNS = int(os.getenv("HISTORY_WINDOW_TURNS", "20"))
+HISTORY_COMPACT_SLACK = int(os.getenv("HISTORY_COMPACT_SLACK", "5"))
+HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "4000"))
+# Characters kept from each side of a folded turn
+SUMMARY_CLIP_CHARS = 160
+
+
+def _role(message) -> str:
+    if isinstance(message, dict):
+        return message.get("role", "assistant")
+    return "user" if isinstance(message, HumanMessage) else "assistant"
+
+
+def _content(message) -> str:
+    return message.get("content", "") if isinstance(message, dict) else str(message.content)
+
+
+def _clip(text: str, limit: int = SUMMARY_CLIP_CHARS) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def summarize_turns(summary: Optional[str], messages: List, max_chars: int = HISTORY_SUMMARY_MAX_CHARS) -> str:
+    """
+    Fold messages into the running summary, one line per turn. Oldest lines
+    are dropped once the summary is over max_chars. No LLM involved.
+    """
+    lines = summary.splitlines() if summary else []
+    user, replies = None, []
+
+    def flush():
+        if user is not None or replies:
+            line = f"- User: {_clip(user or '')}"
+            if replies:
+                line += f" | Assistant: {_clip(replies[0])}"
+            lines.append(line)
+
+    for message in messages:
+        if _role(message) == "user":
+            flush()
+            user, replies = _content(message), []
+        else:
+            replies.append(_content(message))
+    flush()
+
+    while lines and sum(len(line) + 1 for line in lines) > max_chars:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def compact_history(
+    state: Dict,
+    window: int = HISTORY_WINDOW_TURNS,
+    slack: int = HISTORY_COMPACT_SLACK,
+) -> Dict:
+    """
+    Apply the history window between turns: returns a new state whose
+    conversation_history holds the last `window` turns, with older ones
+    folded into conversation_summary. Every other key (brief_data, the
+    marketing_* fields, search results) is left untouched.
+    """
+    history = state["conversation_history"]
+    if window <= 0:
+        return state
+
+    turn_starts = [i for i, message in enumerate(history) if _role(message) == "user"]
+    if len(turn_starts) <= window + slack:
+        return state
+
+    cut = turn_starts[-window]
+    return {
+        **state,
+        "conversation_history": history[cut:],
+        "conversation_summary": summarize_turns(state.get("conversation_summary"), history[:cut]),
+        "folded_turns": (state.get("folded_turns") or 0) + len(turn_starts) - window,
+        "folded_messages": (state.get("folded_messages") or 0) + cut,
+    }
+
+
+def history_bytes(state: Dict) -> int:
+    """ Text held for a session's conversation: message contents plus the summary """
+    size = sum(len(_content(message).encode("utf-8")) for message in state["conversation_history"])
+    return size + len((state.get("conversation_summary") or "").encode("utf-8"))
+
+
+class HistoryStats:
+    """ Latest history size of each live session, for /metrics """
+
+    def __init__(self):
+        self._sessions: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, session_id: str, state: Dict) -> None:
+        entry = {
+            "messages": len(state["conversation_history"]),
+            "folded_turns": state.get("folded_turns") or 0,
+            "bytes": history_bytes(state),
+        }
+        with self._lock:
+            self._sessions[session_id] = entry
+
+    def forget(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "window_turns": HISTORY_WINDOW_TURNS,
+            "max_messages": max((s["messages"] for s in sessions), default=0),
+            "max_bytes": max((s["bytes"] for s in sessions), default=0),
+            "total_bytes": sum(s["bytes"] for s in sessions),
+            "folded_turns": sum(s["folded_turns"] for s in sessions),
+        }
+
+
+session_history = HistoryStats()
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from langchain_core.caches import BaseCache, RETURN_VAL_TYPE
+from langchain_core.load import dumps, loads
+
+from cache import TTLCache
+from concurrency import run_blocking
+
+load_dotenv()
+
+# Every chain runs at temperature=0, so identical rendered prompts give
+# functionally identical answers and can be served from here.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+# Next to this module by default, wherever the server is started from
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "llm_cache.db"))
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "256"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+# Run TTL/size eviction on disk every N writes
+LLM_CACHE_EVICT_EVERY = 100
+
+
+class LLMResponseCache(BaseCache):
+    """
+    Two-tier LangChain cache: an in-memory LRU in front of a local sqlite file.
+
+    LangChain passes the serialized messages as `prompt` and the model
+    parameters (deployment, temperature, ...) as `llm_string`; the key is a
+    hash of both.
+    """
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_PATH,
+        memory_size: int = LLM_CACHE_MEMORY_SIZE,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+        ttl: float = LLM_CACHE_TTL,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=memory_size, ttl=ttl)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            created REAL,
+            accessed REAL
+        )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evicted": 0}
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    def _disk_lookup(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row[1] < now - self.ttl:
+                return None
+            self._conn.execute("UPDATE llm_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return loads(row[0])
+
+    def _disk_update(self, key: str, return_val: RETURN_VAL_TYPE) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, dumps(return_val), now, now)
+            )
+            self._conn.commit()
+            self._writes += 1
+            evict = self._writes % LLM_CACHE_EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> None:
+        """ Drop expired entries, then the least recently used beyond max_entries """
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self.ttl,))
+            evicted = cursor.rowcount
+            cursor = self._conn.execute("""
+            DELETE FROM llm_cache WHERE key IN (
+                SELECT key FROM llm_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+            )
+            """, (self.max_entries,))
+            evicted += cursor.rowcount
+            self._conn.commit()
+            self._stats["evicted"] += evicted
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+
+        value = self._disk_lookup(key)
+        if value is None:
+            self._count("misses")
+            return None
+
+        self._count("disk_hits")
+        self.memory.set(key, value)
+        return value
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        self.memory.set(key, return_val)
+        self._disk_update(key, return_val)
+        self._count("writes")
+
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        # Memory hits are served on the event loop, only sqlite goes to a thread
+        key = self._key(prompt, llm_string)
+        value = self.memory.get(key)
+        if value is not None:
+            self._count("memory_hits")
+            return value
+        return await run_blocking(self.lookup, prompt, llm_string)
+
+    async def aupdate(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        await run_blocking(self.update, prompt, llm_string, return_val)
+
+    def clear(self, **kwargs: Any) -> None:
+        self.memory.clear()
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["disk_entries"] = self._conn.execute("SELECT count(*) FROM llm_cache").fetchone()[0]
+
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        stats["memory"] = self.memory.stats()
+        return stats
+
+
+def uncached(model):
+    """ Copy of a chat model that skips the response cache, for chains that want varied output """
+    update = {"cache": False}
+    if "coalesce" in type(model).model_fields:
+        # Nor share an answer with an identical call in flight
+        update["coalesce"] = False
+    return model.model_copy(update=update)
+
+
+llm_cache = LLMResponseCache() if LLM_CACHE_ENABLED else None
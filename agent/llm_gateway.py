@@ -0,0 +1,344 @@
+import asyncio
+import contextvars
+import hashlib
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, message_chunk_to_message
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import ConfigDict
+
+from prompt_budget import count_tokens
+from singleflight import SingleFlight
+
+load_dotenv()
+
+# Keep these a little under the deployment's quota so we queue instead of eating 429s
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "60000"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+# Callers queue for at most this long before getting LLMBusyError
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "20"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+# Output tokens reserved per request until the real usage comes back
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.getenv("LLM_EXPECTED_OUTPUT_TOKENS", "300"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "32"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+# Set per WebSocket turn: called with a "busy" payload when an LLM call has to queue
+busy_notifier: contextvars.ContextVar[Optional[Callable[[Dict], Awaitable[None]]]] = contextvars.ContextVar(
+    "busy_notifier", default=None
+)
+
+
+class LLMBusyError(RuntimeError):
+    """ No LLM capacity within the queue deadline, or the queue is full """
+
+
+class TokenBucket:
+    """
+    Refills at per_minute / 60 per second up to capacity. Azure enforces
+    per-minute quotas over short (1-10s) windows, so the default capacity is
+    one second's worth: a full bucket plus refill never exceeds the quota
+    over any of those windows.
+
+    A request bigger than the bucket waits for a full bucket, then is debited
+    in full and leaves it negative, so the calls after it wait in proportion
+    to its size and throughput stays at the quota however big requests are.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity or self.rate
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """ Seconds until `amount` can be taken, 0 if it can be taken now """
+        self._refill()
+        # Anything up to a full bucket can go; the rest is paid back by waiting afterwards
+        return max(0.0, (min(amount, self.capacity) - self.available) / self.rate)
+
+    def take(self, amount: float) -> None:
+        """ Debit (or refund, if negative) without waiting; may go below zero """
+        self._refill()
+        self.available = min(self.capacity, self.available - amount)
+
+
+class LLMGateway:
+    """
+    Admission control shared by every LLM call in the process: request and
+    token buckets, a cap on calls in flight, and a FIFO queue with a deadline.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        max_queue: int = LLM_MAX_QUEUE,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._order = asyncio.Lock()
+        self._waiting = 0
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "queue_wait_total_s": 0.0}
+
+    def _busy_info(self, tokens: int) -> Dict:
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+        return {
+            "message": "Lots of requests right now, your reply is queued.",
+            "queue_position": self._waiting,
+            "estimated_wait_s": round(wait, 1),
+        }
+
+    async def acquire(self, tokens: int) -> float:
+        """ Wait for a slot for a request of about `tokens` tokens; returns seconds spent queued """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        deadline = start + self.queue_timeout
+
+        if self._waiting >= self.max_queue:
+            self._stats["rejected"] += 1
+            raise LLMBusyError(f"LLM queue is full ({self._waiting} waiting)")
+
+        self._waiting += 1
+        try:
+            must_wait = (
+                self._order.locked() or self._in_flight.locked()
+                or self.requests.wait_time(1) > 0 or self.tokens.wait_time(tokens) > 0
+            )
+            if must_wait:
+                self._stats["queued"] += 1
+                notify = busy_notifier.get()
+                if notify is not None:
+                    await notify(self._busy_info(tokens))
+
+            # Requests leave the buckets in arrival order
+            async with self._order:
+                while True:
+                    wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                    if wait <= 0:
+                        break
+                    if loop.time() + wait > deadline:
+                        self._stats["timed_out"] += 1
+                        raise LLMBusyError(f"No LLM capacity within {self.queue_timeout:.0f}s")
+                    await asyncio.sleep(wait)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+
+            try:
+                await asyncio.wait_for(self._in_flight.acquire(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self.requests.take(-1)
+                self.tokens.take(-tokens)
+                self._stats["timed_out"] += 1
+                raise LLMBusyError(f"{self.max_in_flight} LLM calls already in flight")
+        finally:
+            self._waiting -= 1
+
+        waited = loop.time() - start
+        self._stats["admitted"] += 1
+        self._stats["queue_wait_total_s"] += waited
+        return waited
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int] = None) -> None:
+        """ Free the in-flight slot and settle the token estimate against real usage """
+        self._in_flight.release()
+        if used_tokens is not None:
+            self.tokens.take(used_tokens - estimated_tokens)
+
+    def stats(self) -> Dict:
+        return {
+            **self._stats,
+            "waiting": self._waiting,
+            "in_flight": self.max_in_flight - self._in_flight._value,
+            "requests_available": round(self.requests.available, 1),
+            "tokens_available": round(self.tokens.available),
+        }
+
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    return sum(count_tokens(str(message.content)) + 4 for message in messages) + LLM_EXPECTED_OUTPUT_TOKENS
+
+
+def _used_tokens(result: ChatResult) -> Optional[int]:
+    usage = (result.llm_output or {}).get("token_usage") or {}
+    return usage.get("total_tokens")
+
+
+class GatewayChatModel(BaseChatModel):
+    """
+    Wraps a chat model so every uncached call goes through an LLMGateway.
+    The response cache sits on this wrapper, so cache hits never queue, and
+    identical concurrent calls are coalesced into one.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: BaseChatModel
+    gateway: LLMGateway
+    # Independent of `cache`: a deployment without the response cache still coalesces
+    coalesce: bool = True
+
+    @property
+    def _llm_type(self) -> str:
+        return self.model._llm_type
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        # Same cache keys as the wrapped model
+        return self.model._identifying_params
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # The graph nodes are async; sync callers (scripts) go straight through
+        return self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        yield from self.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _flight_key(self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs: Any) -> Optional[str]:
+        """ Same key scheme as the response cache; None for calls that opted out of coalescing """
+        if not self.coalesce:
+            # uncached() callers (e.g. greetings at temperature 0.9) want a fresh answer each time
+            return None
+        llm_string = self._get_llm_string(stop=stop, **kwargs)
+        return hashlib.sha256(f"{llm_string}\x00{dumps(messages)}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    async def _follow(future: asyncio.Future) -> Optional[ChatResult]:
+        """ Wait for an identical call in flight; None if it was cancelled and we should run our own """
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            return None
+        # Callers attach run ids to the message, so each gets its own copy
+        return result.model_copy(deep=True)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._flight_key(messages, stop, **kwargs)
+        future = llm_calls.join(key) if key else None
+        if future is not None:
+            result = await self._follow(future)
+            if result is not None:
+                return result
+
+        future = llm_calls.begin(key) if key else None
+        estimated = estimate_tokens(messages)
+        used = None
+        try:
+            await self.gateway.acquire(estimated)
+            try:
+                result = await self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                used = _used_tokens(result)
+            finally:
+                self.gateway.release(estimated, used)
+        except BaseException as e:
+            if future is not None:
+                llm_calls.fail(key, future, e)
+            raise
+
+        if future is not None:
+            llm_calls.finish(key, future, result)
+        return result
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._flight_key(messages, stop, **kwargs)
+        future = llm_calls.join(key) if key else None
+        if future is not None:
+            result = await self._follow(future)
+            if result is not None:
+                # The leader streamed to its own session; this one gets the answer as a single chunk
+                message = result.generations[0].message
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=message.content))
+                if run_manager:
+                    await run_manager.on_llm_new_token(str(message.content), chunk=chunk)
+                yield chunk
+                return
+
+        future = llm_calls.begin(key) if key else None
+        estimated = estimate_tokens(messages)
+        used = None
+        combined = None
+        try:
+            await self.gateway.acquire(estimated)
+            try:
+                async for chunk in self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    usage = getattr(chunk.message, "usage_metadata", None)
+                    if usage:
+                        used = usage.get("total_tokens")
+                    combined = chunk if combined is None else combined + chunk
+                    yield chunk
+            finally:
+                self.gateway.release(estimated, used)
+        except GeneratorExit:
+            # The consumer stopped early; followers run their own call
+            if future is not None:
+                llm_calls.fail(key, future, asyncio.CancelledError())
+            raise
+        except BaseException as e:
+            if future is not None:
+                llm_calls.fail(key, future, e)
+            raise
+
+        if future is not None:
+            message = message_chunk_to_message(combined.message) if combined else AIMessage(content="")
+            llm_calls.finish(key, future, ChatResult(generations=[ChatGeneration(message=message)]))
+
+
+def http_clients(max_connections: int = LLM_MAX_CONNECTIONS, timeout: float = LLM_REQUEST_TIMEOUT) -> Dict:
+    """ Pooled keep-alive HTTP clients to hand to AzureChatOpenAI """
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return {
+        "http_client": httpx.Client(limits=limits, timeout=timeout),
+        "http_async_client": httpx.AsyncClient(limits=limits, timeout=timeout),
+    }
+
+
+llm_gateway = LLMGateway()
+# Sessions sending the exact same prompt at the same moment share one call
+llm_calls = SingleFlight("llm")
@@ -0,0 +1,40 @@
+import statistics
+import threading
+from collections import defaultdict, deque
+from typing import Deque, Dict
+
+
+class LatencyRecorder:
+    """ Keeps the last `window` samples (seconds) per key and summarizes them in ms """
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[key].append(seconds)
+            self._counts[key] += 1
+
+    def summary(self) -> Dict[str, Dict]:
+        with self._lock:
+            snapshot = {key: sorted(samples) for key, samples in self._samples.items()}
+            counts = dict(self._counts)
+
+        summary = {}
+        for key, samples in snapshot.items():
+            if not samples:
+                continue
+            summary[key] = {
+                "count": counts[key],
+                "p50_ms": round(statistics.median(samples) * 1000, 3),
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+                "max_ms": round(samples[-1] * 1000, 3),
+            }
+        return summary
+
+
+# Per-node latency of graph turns, e.g. "greet.ttft" and "greet.total"
+node_latency = LatencyRecorder()
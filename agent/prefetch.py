@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from concurrency import run_blocking
+from schema import ProductSearchResults
+from singleflight import SingleFlight
+from tools import ProductLookupTool, normalize_query, transform_to_product_table
+
+load_dotenv()
+
+# Unclaimed lookups (the brief was abandoned) are dropped after this many seconds
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "300"))
+
+
+def lookup_product_table(name: str) -> Tuple[ProductSearchResults, Dict]:
+    """ Product search plus its table transform, the blocking half of get_product_table """
+    results = ProductLookupTool().invoke(name)
+    return results, transform_to_product_table(results)
+
+
+# Sessions looking up the same product at the same moment share one query
+product_lookups = SingleFlight("product_lookup")
+
+
+async def fetch_product_table(name: str) -> Tuple[ProductSearchResults, Dict]:
+    return await product_lookups.do(normalize_query(name), lambda: run_blocking(lookup_product_table, name))
+
+
+class ProductPrefetcher:
+    """
+    Starts product lookups as soon as a product name is known, while the rest
+    of the brief is still being collected, so get_product_table can pick up
+    the finished result instead of querying on the final turn.
+
+    Lookups are keyed by normalized name and reference counted, so sessions
+    asking for the same product share one task and a session changing its
+    product only cancels the lookup if nobody else is waiting on it.
+    """
+
+    def __init__(self, ttl: float = PREFETCH_TTL):
+        self.ttl = ttl
+        # key -> [task, refs, started]
+        self._lookups: Dict[str, list] = {}
+        self._stats = {"started": 0, "shared": 0, "hits": 0, "misses": 0, "cancelled": 0, "expired": 0}
+
+    def _prune(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        for key, (task, _, started) in list(self._lookups.items()):
+            if started < cutoff:
+                task.cancel()
+                del self._lookups[key]
+                self._stats["expired"] += 1
+
+    def start(self, name: str) -> None:
+        """ Begin looking up `name` in the background, or join a lookup already running """
+        self._prune()
+        key = normalize_query(name)
+        if key in self._lookups:
+            self._lookups[key][1] += 1
+            self._stats["shared"] += 1
+            return
+
+        task = asyncio.create_task(fetch_product_table(name))
+        # Failures surface in take(); don't log them as never-retrieved
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._lookups[key] = [task, 1, time.monotonic()]
+        self._stats["started"] += 1
+
+    def cancel(self, name: str) -> None:
+        """ Drop this caller's interest in `name`, cancelling the lookup if it was the last one """
+        key = normalize_query(name)
+        entry = self._lookups.get(key)
+        if entry is None:
+            return
+
+        entry[1] -= 1
+        if entry[1] <= 0:
+            # The thread finishes regardless, this only discards the result
+            entry[0].cancel()
+            del self._lookups[key]
+            self._stats["cancelled"] += 1
+
+    async def take(self, name: str) -> Optional[Tuple[ProductSearchResults, Dict]]:
+        """ Await the prefetched (results, table) for `name`, or None if there isn't a usable one """
+        key = normalize_query(name)
+        entry = self._lookups.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+
+        task = entry[0]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._lookups[key]
+
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            self._stats["misses"] += 1
+            return None
+        except Exception as e:
+            # Let the caller run the lookup itself and report the error
+            print(f"Prefetched lookup for {name} failed: {e}")
+            self._stats["misses"] += 1
+            return None
+
+        self._stats["hits"] += 1
+        return result
+
+    def stats(self) -> Dict:
+        return {**self._stats, "pending": len(self._lookups)}
+
+
+product_prefetcher = ProductPrefetcher()
@@ -0,0 +1,135 @@
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tokens allowed for the table section of the get_product_table prompt
+PROMPT_TABLE_TOKEN_BUDGET = int(os.getenv("PROMPT_TABLE_TOKEN_BUDGET", "1000"))
+PROMPT_SAMPLES_PER_ROW = int(os.getenv("PROMPT_SAMPLES_PER_ROW", "5"))
+TOKENIZER_MODEL = os.getenv("TOKENIZER_MODEL", "gpt-4o")
+# A sample SKU name cut to fit the budget keeps at least this many characters
+SAMPLE_NAME_MIN_CHARS = 20
+
+# Rough stand-in when tiktoken can't load its encoding (it downloads it on first use)
+ESTIMATE_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+    except Exception as e:
+        print(f"tiktoken unavailable ({e.__class__.__name__}), estimating token counts")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return len(ESTIMATE_PATTERN.findall(text))
+    return len(encoding.encode(text))
+
+
+def _truncate(name: str, chars: Optional[int]) -> str:
+    return name if chars is None or len(name) <= chars else name[:chars].rstrip() + "..."
+
+
+def format_table_row(row: Dict, samples: int, name_chars: Optional[int] = None) -> str:
+    sku_samples = ", ".join([f"{_truncate(s['name'], name_chars)} (SKU: {s['sku']})" for s in row["skus"][:samples]])
+    return (
+        f"- {row['buyer_category']} > {row['product_category']}:\n"
+        f"  * Sample SKUs: {sku_samples}\n"
+        f"  * Total SKUs: {row['count']}\n"
+        f"  * SKUs in category: {row['category_total'] or 'unknown'}"
+    )
+
+
+def rank_rows(rows: List[Dict]) -> List[Dict]:
+    """ Most matching SKUs first; ties go to the category the query makes up more of """
+    return sorted(
+        rows,
+        key=lambda row: (row["count"], row["count"] / (row["category_total"] or row["count"] or 1)),
+        reverse=True
+    )
+
+
+def _fit_name(row: Dict, budget: int) -> int:
+    """
+    Longest sample SKU name (in characters) that keeps a one-sample row within
+    budget, but never under SAMPLE_NAME_MIN_CHARS so the name is still recognisable
+    """
+    name = row["skus"][0]["name"] if row["skus"] else ""
+    low, high = min(SAMPLE_NAME_MIN_CHARS, len(name)), len(name)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(format_table_row(row, 1, middle)) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def build_table_prompt(
+    product_table: Dict,
+    budget: Optional[int] = PROMPT_TABLE_TOKEN_BUDGET,
+    max_samples: int = PROMPT_SAMPLES_PER_ROW,
+) -> Dict:
+    """
+    Render the table rows for the recommendation prompt within `budget` tokens.
+
+    Rows are added best first with one sample SKU each; whatever budget is
+    left then buys more samples, again best rows first. Rows that don't fit
+    are summarized in one line. The best row is always included, with its
+    sample SKU name cut short if even that row is over budget, so the LLM
+    has something to recommend. budget=None includes everything.
+    """
+    rows = rank_rows(product_table["rows"])
+
+    if budget is None:
+        included = [[row, max_samples, None] for row in rows]
+    else:
+        used, included = 0, []
+        for row in rows:
+            cost = count_tokens(format_table_row(row, 1))
+            if used + cost > budget:
+                if not included:
+                    name_chars = _fit_name(row, budget)
+                    included.append([row, 1, name_chars])
+                    used += count_tokens(format_table_row(row, 1, name_chars))
+                break
+            included.append([row, 1, None])
+            used += cost
+
+        for samples in range(2, max_samples + 1):
+            for item in included:
+                row = item[0]
+                if len(row["skus"]) < samples or item[2] is not None:
+                    continue
+                extra = count_tokens(format_table_row(row, samples)) - count_tokens(format_table_row(row, samples - 1))
+                if used + extra > budget:
+                    continue
+                item[1] = samples
+                used += extra
+
+    sections = [format_table_row(row, samples, name_chars) for row, samples, name_chars in included]
+    omitted = rows[len(included):]
+    if omitted:
+        sections.append(
+            f"- ...and {len(omitted)} more category combinations "
+            f"({sum(row['count'] for row in omitted)} matching SKUs)"
+        )
+
+    table_data = "\n\n".join(sections)
+    return {
+        "table_data": table_data,
+        "buyer_categories": ", ".join(dict.fromkeys(row["buyer_category"] for row, _, _ in included)),
+        "product_categories": ", ".join(dict.fromkeys(row["product_category"] for row, _, _ in included)),
+        "rows_included": len(included),
+        "rows_total": len(rows),
+        "table_tokens": count_tokens(table_data),
+    }
@@ -1,4 +1,5 @@
 # schema.py
+from functools import cached_property
 from typing import Annotated, List, Optional, Union, TypedDict, Dict
 from pydantic import BaseModel, Field
 from langchain_core.messages import HumanMessage, AIMessage
@@ -16,14 +17,99 @@ class ProductDetails(BaseModel):
     buyer_category: Optional[str] = Field(None, description="The buyer category (L4)")
     product_category: Optional[str] = Field(None, description="The product category (L5)")
 
+class CategoryCount(BaseModel):
+    """Number of SKUs in a buyer/product category combination"""
+    buyer_category: str
+    product_category: str
+    count: int
+
 class ProductSearchResults(BaseModel):
+    """
+    Columnar search results. Row i is skus[i], names[i] with categories
+    buyer_categories[buyer_category_ids[i]] and product_categories[product_category_ids[i]];
+    category names are stored once and referenced by integer id.
+    """
     query: str
     total_results: int
-    unique_buyer_categories: List[str]
-    unique_product_categories: List[str]
-    by_buyer_category: Dict[str, List[ProductDetails]]
-    by_product_category: Dict[str, List[ProductDetails]]
-    all_products: List[ProductDetails]
+    skus: List[Union[str, int]] = Field(default_factory=list)
+    names: List[str] = Field(default_factory=list)
+    buyer_category_ids: List[int] = Field(default_factory=list)
+    product_category_ids: List[int] = Field(default_factory=list)
+    buyer_categories: List[str] = Field(default_factory=list, description="Interned buyer categories (L4), index = id")
+    product_categories: List[str] = Field(default_factory=list, description="Interned product categories (L5), index = id")
+    total_matches: Optional[int] = Field(None, description="SKUs matching the query across the whole catalog")
+    category_match_counts: List[CategoryCount] = Field(default_factory=list, description="Matches per category across the whole catalog")
+    next_cursor: Optional[str] = Field(None, description="Keyset cursor for the next page of results, if any")
+
+    @classmethod
+    def from_rows(cls, query: str, rows: List[tuple], **kwargs) -> "ProductSearchResults":
+        """ Build from (sku, name, buyer_category, product_category) rows in a single pass """
+        skus, names, buyer_ids, product_ids = [], [], [], []
+        buyer_index: Dict[str, int] = {}
+        product_index: Dict[str, int] = {}
+
+        for sku, name, buyer_category, product_category in rows:
+            skus.append(sku)
+            names.append(name)
+            buyer_ids.append(buyer_index.setdefault(buyer_category, len(buyer_index)))
+            product_ids.append(product_index.setdefault(product_category, len(product_index)))
+
+        return cls(
+            query=query,
+            skus=skus,
+            names=names,
+            buyer_category_ids=buyer_ids,
+            product_category_ids=product_ids,
+            buyer_categories=list(buyer_index),
+            product_categories=list(product_index),
+            **kwargs
+        )
+
+    def __len__(self) -> int:
+        return len(self.skus)
+
+    @property
+    def unique_buyer_categories(self) -> List[str]:
+        return self.buyer_categories
+
+    @property
+    def unique_product_categories(self) -> List[str]:
+        return self.product_categories
+
+    # Row-object views, only built if something asks for them
+
+    @cached_property
+    def all_products(self) -> List[ProductDetails]:
+        return [
+            ProductDetails(
+                sku=sku,
+                product_name=name,
+                buyer_category=self.buyer_categories[buyer_id],
+                product_category=self.product_categories[product_id]
+            )
+            for sku, name, buyer_id, product_id in zip(
+                self.skus, self.names, self.buyer_category_ids, self.product_category_ids
+            )
+        ]
+
+    @cached_property
+    def by_buyer_category(self) -> Dict[str, List[ProductDetails]]:
+        grouped = {category: [] for category in self.buyer_categories}
+        for product in self.all_products:
+            grouped[product.buyer_category].append(product)
+        return grouped
+
+    @cached_property
+    def by_product_category(self) -> Dict[str, List[ProductDetails]]:
+        grouped = {category: [] for category in self.product_categories}
+        for product in self.all_products:
+            grouped[product.product_category].append(product)
+        return grouped
+
+class SKUBatchResults(BaseModel):
+    """Schema for a bulk SKU lookup, keyed on the SKU as a string"""
+    found: Dict[str, ProductDetails] = Field(default_factory=dict, description="Resolved SKUs")
+    not_found: List[str] = Field(default_factory=list, description="SKUs missing from the database")
 
 class SelectedCategory(BaseModel):
     """Schema for selected audience category"""
@@ -35,8 +121,17 @@ class AudienceSelections(BaseModel):
     categories: List[SelectedCategory] = Field(default_factory=list, description="Selected categories")
     created_at: Optional[str] = Field(None, description="When the audience was created")
 
+def append_messages(history: List, new_messages: List) -> List:
+    """
+    Reducer for conversation_history: nodes return only their new messages,
+    which are appended to a new list. Neither argument is modified, so the
+    caller's copy of the history stays as it was passed in. The history is
+    bounded by compact_history, so the copy stays small.
+    """
+    return history + new_messages
+
 class AudienceBuilderState(TypedDict):
-    conversation_history: Annotated[List[Union[HumanMessage, AIMessage, Dict]], "conversation history", "append"]
+    conversation_history: Annotated[List[Union[HumanMessage, AIMessage, Dict]], "conversation history", append_messages]
     sku: Annotated[Optional[str], "The product sku the user wants"]
     product_name: Annotated[Optional[str], "Product name from DB"]
     product_category: Annotated[Optional[str], "Product category from DB"]
@@ -44,4 +139,13 @@ class AudienceBuilderState(TypedDict):
     product_search_results: Annotated[Optional[ProductSearchResults], "Product search results from DB"]
     product_table: Annotated[Optional[Dict], "Structured table data for UI rendering"]
     audience_selections: Annotated[Optional[AudienceSelections], "User's audience building selections"]
+    conversation_summary: Annotated[Optional[str], "Turns folded out of conversation_history, one line each"]
+    folded_turns: Annotated[Optional[int], "Number of turns folded into conversation_summary"]
+    folded_messages: Annotated[Optional[int], "Number of messages folded into conversation_summary"]
+    brief_data: Annotated[Optional[Dict[str, str]], "Marketing brief fields captured so far"]
+    prefetched_product: Annotated[Optional[str], "Product whose background lookup this session still holds a reference to"]
+    marketing_objectives: Annotated[Optional[str], "Objectives from the brief"]
+    marketing_budget: Annotated[Optional[str], "Budget from the brief"]
+    marketing_channel: Annotated[Optional[str], "Channel from the brief"]
+    marketing_duration: Annotated[Optional[str], "Duration from the brief"]
     current_node: str
\ No newline at end of file
@@ -0,0 +1,334 @@
+import base64
+import json
+import re
+import sqlite3
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from cache import TTLCache
+
+# FTS5 shadow index over DIM_ITEMS.skuName, used by ProductLookupTool
+# instead of the LIKE '%...%' scans.
+FTS_TABLE = "DIM_ITEMS_FTS"
+FTS_META_TABLE = "DIM_ITEMS_FTS_META"
+# SKU count per (catLevel4Name, catLevel5Name), rebuilt together with the index
+ROLLUP_TABLE = "DIM_ITEMS_CATEGORY_ROLLUP"
+SEARCH_LIMIT = 50
+
+# Original query, kept as the fallback when FTS5 isn't compiled into sqlite
+# and as the baseline for benchmark.py
+LEGACY_SEARCH_QUERY = """
+SELECT
+    skuId,
+    skuName,
+    catLevel4Name,
+    catLevel5Name
+FROM
+    DIM_ITEMS
+WHERE
+    (
+        skuName LIKE ? || '%' OR
+        skuName LIKE '%' || ? OR
+        skuName LIKE '%' || ? || '%'
+    )
+    AND catLevel4Name != 'NOT IN USE'
+    AND catLevel5Name != 'NOT IN USE'
+ORDER BY
+    CASE
+        WHEN skuName = ? THEN 10
+        WHEN skuName LIKE ? || '%' THEN 8
+        WHEN skuName LIKE '%' || ? || '%' THEN 6
+        ELSE 1
+    END DESC
+LIMIT ?;
+"""
+
+# Keyset pagination over the ranked matches: bm25() is lower-is-better and
+# rowid breaks ties, so (score, rowid) of the last row is the cursor
+FTS_PAGE_QUERY = f"""
+SELECT rowid, skuId, skuName, catLevel4Name, catLevel5Name, score
+FROM (
+    SELECT rowid, skuId, skuName, catLevel4Name, catLevel5Name, bm25({FTS_TABLE}) AS score
+    FROM {FTS_TABLE}
+    WHERE {FTS_TABLE} MATCH ?
+)
+WHERE score > ? OR (score = ? AND rowid > ?)
+ORDER BY score, rowid
+LIMIT ?;
+"""
+
+# Every match in rank order, same order as FTS_PAGE_QUERY. Paging through a
+# cached ranking avoids scoring all matches again for each page.
+FTS_RANKING_QUERY = f"""
+SELECT rowid, bm25({FTS_TABLE}) AS score
+FROM {FTS_TABLE}
+WHERE {FTS_TABLE} MATCH ?
+ORDER BY score, rowid;
+"""
+
+FTS_ROWS_QUERY = f"""
+SELECT rowid, skuId, skuName, catLevel4Name, catLevel5Name
+FROM {FTS_TABLE}
+WHERE rowid IN ({{placeholders}});
+"""
+
+# Categories marked 'NOT IN USE' are dropped at build time so the search
+# query doesn't have to filter them
+BUILD_INDEX_QUERY = f"""
+INSERT INTO {FTS_TABLE} (skuName, skuId, catLevel4Name, catLevel5Name)
+SELECT skuName, skuId, catLevel4Name, catLevel5Name
+FROM DIM_ITEMS
+WHERE skuName IS NOT NULL
+    AND catLevel4Name != 'NOT IN USE'
+    AND catLevel5Name != 'NOT IN USE';
+"""
+
+CATEGORY_ROLLUP_QUERY = """
+SELECT catLevel4Name, catLevel5Name, count(*)
+FROM DIM_ITEMS
+WHERE catLevel4Name != 'NOT IN USE'
+    AND catLevel5Name != 'NOT IN USE'
+GROUP BY catLevel4Name, catLevel5Name
+"""
+
+BUILD_ROLLUP_QUERY = f"""
+INSERT INTO {ROLLUP_TABLE} (catLevel4Name, catLevel5Name, skuCount)
+{CATEGORY_ROLLUP_QUERY};
+"""
+
+FTS_CATEGORY_COUNT_QUERY = f"""
+SELECT catLevel4Name, catLevel5Name, count(*)
+FROM {FTS_TABLE}
+WHERE {FTS_TABLE} MATCH ?
+GROUP BY catLevel4Name, catLevel5Name;
+"""
+
+# Databases already checked (and built if needed) by this process
+_ready_indexes = {}
+
+
+def fts5_available(conn: sqlite3.Connection) -> bool:
+    """ Check whether this sqlite build has the FTS5 extension """
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def catalog_signature(conn: sqlite3.Connection, version_query: str = "") -> str:
+    """
+    Cheap fingerprint of DIM_ITEMS used to detect a stale index. Row count and
+    max rowid miss rows edited in place; version_query (a query returning one
+    catalog version value) covers those.
+    """
+    count, max_rowid = conn.execute("SELECT count(*), max(rowid) FROM DIM_ITEMS").fetchone()
+    signature = f"{count}:{max_rowid}"
+    if version_query:
+        row = conn.execute(version_query).fetchone()
+        signature += f":{row[0] if row else None}"
+    return signature
+
+
+def build_search_index(conn: sqlite3.Connection, version_query: str = "") -> None:
+    """ (Re)build the FTS5 shadow table from DIM_ITEMS """
+    print(f"Building search index {FTS_TABLE} and {ROLLUP_TABLE}")
+    with conn:
+        conn.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+            skuName,
+            skuId UNINDEXED,
+            catLevel4Name UNINDEXED,
+            catLevel5Name UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        )
+        """)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {FTS_META_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute(f"DELETE FROM {FTS_TABLE}")
+        conn.execute(BUILD_INDEX_QUERY)
+        conn.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+        conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+            catLevel4Name TEXT,
+            catLevel5Name TEXT,
+            skuCount INTEGER,
+            PRIMARY KEY (catLevel4Name, catLevel5Name)
+        ) WITHOUT ROWID
+        """)
+        conn.execute(f"DELETE FROM {ROLLUP_TABLE}")
+        conn.execute(BUILD_ROLLUP_QUERY)
+        conn.execute(
+            f"INSERT OR REPLACE INTO {FTS_META_TABLE} (key, value) VALUES ('signature', ?)",
+            (catalog_signature(conn, version_query),)
+        )
+
+
+def ensure_search_index(
+    conn: sqlite3.Connection,
+    db_path: str,
+    force: bool = False,
+    recheck: bool = False,
+    version_query: str = "",
+) -> bool:
+    """
+    Make sure the FTS5 index exists and matches the current catalog.
+    Only checked once per database per process unless recheck=True;
+    force=True rebuilds even if the stored signature matches.
+
+    Returns False when FTS5 can't be used, so callers fall back to LIKE.
+    """
+    if not force and not recheck and db_path in _ready_indexes:
+        return _ready_indexes[db_path]
+
+    if not fts5_available(conn):
+        print("FTS5 not available, falling back to LIKE search")
+        _ready_indexes[db_path] = False
+        return False
+
+    try:
+        stored = conn.execute(
+            f"SELECT value FROM {FTS_META_TABLE} WHERE key = 'signature'"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        stored = None
+
+    try:
+        if force or not stored or stored[0] != catalog_signature(conn, version_query):
+            build_search_index(conn, version_query)
+        _ready_indexes[db_path] = True
+    except sqlite3.OperationalError as e:
+        # e.g. the database is read-only and the index was never built
+        print(f"Could not build search index: {e}")
+        _ready_indexes[db_path] = False
+
+    return _ready_indexes[db_path]
+
+
+def to_match_query(name: str) -> str:
+    """
+    Turn a free-text product name into an FTS5 MATCH expression where every
+    word is a quoted prefix term, e.g. 'Kit Kat' -> '"kit"* "kat"*'
+    """
+    tokens = re.findall(r"\w+", name.lower())
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def encode_cursor(score: float, rowid: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, rowid]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        score, rowid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(rowid)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid page cursor: {cursor}") from e
+
+
+def _ranking(conn: sqlite3.Connection, match_query: str, ranking_cache: TTLCache) -> Tuple[array, array]:
+    """ (scores, rowids) of every match in rank order, 16 bytes per match """
+    ranking = ranking_cache.get(match_query)
+    if ranking is None:
+        scores, rowids = array("d"), array("q")
+        for rowid, score in conn.execute(FTS_RANKING_QUERY, (match_query,)):
+            scores.append(score)
+            rowids.append(rowid)
+        ranking = (scores, rowids)
+        ranking_cache.set(match_query, ranking)
+    return ranking
+
+
+def _ranked_page(
+    conn: sqlite3.Connection,
+    match_query: str,
+    score: float,
+    rowid: int,
+    limit: int,
+    ranking_cache: TTLCache,
+) -> List[tuple]:
+    """ Same rows as FTS_PAGE_QUERY, sliced from the cached ranking """
+    scores, rowids = _ranking(conn, match_query, ranking_cache)
+    # First entry after (score, rowid): rowids ascend within a run of equal scores
+    low, high = bisect_left(scores, score), bisect_right(scores, score)
+    start = bisect_right(rowids, rowid, low, high)
+    page = range(start, min(start + limit, len(rowids)))
+    if not page:
+        return []
+
+    wanted = [rowids[i] for i in page]
+    query = FTS_ROWS_QUERY.format(placeholders=", ".join("?" * len(wanted)))
+    found = {row[0]: row for row in conn.execute(query, wanted)}
+    return [(*found[rowids[i]], scores[i]) for i in page if rowids[i] in found]
+
+
+def search_products_page(
+    conn: sqlite3.Connection,
+    name: str,
+    cursor: Optional[str] = None,
+    use_index: bool = True,
+    limit: int = SEARCH_LIMIT,
+    ranking_cache: Optional[TTLCache] = None,
+) -> Tuple[List[tuple], Optional[str]]:
+    """
+    One page of (skuId, skuName, catLevel4Name, catLevel5Name) rows ranked by
+    relevance, plus the cursor for the next page (None when there are no more).
+    Only the FTS5 index can be paged; the LIKE fallback returns a single page.
+
+    The first page is a top-k query. Later pages would score every match
+    again, so with a ranking_cache they're sliced from the full ranking,
+    computed once per query. The caller clears the cache when the catalog
+    changes, since rowids don't survive an index rebuild.
+    """
+    match_query = to_match_query(name)
+
+    if not (use_index and match_query):
+        if cursor:
+            return [], None
+        params = (name, name, name, name, name, name, limit)
+        return conn.execute(LEGACY_SEARCH_QUERY, params).fetchall(), None
+
+    score, rowid = decode_cursor(cursor) if cursor else (float("-inf"), -1)
+    # One extra row tells us whether there is a next page
+    if cursor and ranking_cache is not None:
+        rows = _ranked_page(conn, match_query, score, rowid, limit + 1, ranking_cache)
+    else:
+        rows = conn.execute(FTS_PAGE_QUERY, (match_query, score, score, rowid, limit + 1)).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][5], rows[-1][0])
+
+    return [row[1:5] for row in rows], next_cursor
+
+
+def search_products(conn: sqlite3.Connection, name: str, use_index: bool = True, limit: int = SEARCH_LIMIT) -> list:
+    """ Return the first page of (skuId, skuName, catLevel4Name, catLevel5Name) rows ranked by relevance """
+    rows, _ = search_products_page(conn, name, use_index=use_index, limit=limit)
+    return rows
+
+
+def load_category_rollup(conn: sqlite3.Connection) -> Dict[Tuple[str, str], int]:
+    """
+    Total SKU count per (buyer category, product category) for the whole catalog.
+    Reads the materialized rollup, or aggregates DIM_ITEMS once if it doesn't exist.
+    """
+    try:
+        rows = conn.execute(f"SELECT catLevel4Name, catLevel5Name, skuCount FROM {ROLLUP_TABLE}").fetchall()
+    except sqlite3.OperationalError:
+        print(f"{ROLLUP_TABLE} not found, aggregating DIM_ITEMS")
+        rows = conn.execute(CATEGORY_ROLLUP_QUERY).fetchall()
+
+    return {(row[0], row[1]): row[2] for row in rows}
+
+
+def count_matches_by_category(conn: sqlite3.Connection, name: str) -> Dict[Tuple[str, str], int]:
+    """ Number of SKUs matching the query per category, over the whole index (not just the LIMIT) """
+    match_query = to_match_query(name)
+    if not match_query:
+        return {}
+    rows = conn.execute(FTS_CATEGORY_COUNT_QUERY, (match_query,)).fetchall()
+    return {(row[0], row[1]): row[2] for row in rows}
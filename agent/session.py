@@ -1,30 +1,117 @@
 import os
-import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
 from dotenv import load_dotenv
 from typing import Dict, Optional
 from uuid import uuid4
 import logging
-from redis import Redis
+from redis.asyncio import ConnectionPool, Redis
 
-from dialogue_manager import get_initial_state, create_workflow
+from dialogue_manager import get_initial_state
+from metrics import LatencyRecorder
+from state_codec import encode, decode
 
 load_dotenv()
 REDIS_URL = os.getenv("REDIS_URL")
-
-os.makedirs("agent/logs", exist_ok=True)
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+# Hot sessions kept in memory, and how often dirty ones are written back
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "1.0"))
 
 # logging.basicConfig(level=logging.INFO, filename="agent/logs/session.log")
 # logger = logging.getLogger(__name__)
 
 # TODO: Use Langchain Output Parsers (JSON)
 
+# Large values that rarely change: stored once under their content hash and
+# referenced from the session hash, so a turn doesn't rewrite them
+BLOB_FIELDS = {"product_search_results", "product_table"}
+BLOB_REF_PREFIX = b"blob:"
+
+# Positions in the session's message list, kept in the hash next to the fields.
+# Indexes are absolute: messages_start counts messages trimmed off the front
+MESSAGES_START = "_messages_start"
+MESSAGES_END = "_messages_end"
+
 
 class SessionManager:
-    def __init__(self, redis_url: str = REDIS_URL):
-        self.redis = Redis.from_url(redis_url, decode_responses=True)
+    """
+    Sessions in Redis as deltas rather than one JSON blob per save:
+
+    - session:{id}:messages  list, new messages RPUSHed, folded ones LTRIMmed
+    - session:{id}           hash, one field per scalar state key
+    - session:blob:{sha256}  large values (BLOB_FIELDS), written once by content
+
+    Values are encoded with state_codec, so messages and search results come
+    back as the objects they were. A write sends only what changed since the last one in a single pipeline,
+    and refreshes the TTL of every key the session uses.
+
+    Hot sessions live in a bounded in-process LRU in front of Redis.
+    save_state() only updates memory and marks the session dirty; dirty
+    sessions are written back by a background task every flush_interval
+    seconds, or right away with flush(). A session in memory never costs a
+    Redis round trip.
+    """
+
+    def __init__(
+        self,
+        redis_url: str = REDIS_URL,
+        redis: Optional[Redis] = None,
+        cache_size: int = SESSION_CACHE_SIZE,
+        flush_interval: float = SESSION_FLUSH_INTERVAL,
+    ):
+        if redis is None:
+            pool = ConnectionPool.from_url(redis_url, max_connections=REDIS_MAX_CONNECTIONS)
+            redis = Redis(connection_pool=pool)
+        self.redis = redis
         self.session_ttl = 3600
-        self.workflow = create_workflow()
-        
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+
+        self._sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        # session_id -> when it became dirty; evicted dirty sessions wait in _evicted until written
+        self._dirty: Dict[str, float] = {}
+        self._evicted: Dict[str, Dict] = {}
+        # Last written hash fields and list positions per session, to work out the delta
+        self._saved: Dict[str, Dict[str, bytes]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.latency = LatencyRecorder()
+        self._stats = {
+            "hits": 0, "misses": 0, "evictions": 0, "flushes": 0,
+            "flush_errors": 0, "bytes_written": 0, "blobs_written": 0,
+        }
+
+    def _keys(self, session_id: str):
+        return f"session:{session_id}", f"session:{session_id}:messages"
+
+    def start(self) -> None:
+        """ Start the background flusher (needs a running event loop) """
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """ Stop the flusher and write back everything still dirty """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        await self.redis.aclose()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Session flush failed: {e}")
+
     def create_session(self) -> str:
         session_id = str(uuid4())
         initial_state = get_initial_state()
@@ -33,39 +120,167 @@ class SessionManager:
         # logger.info(f"Initial state: {initial_state}")
 
         return session_id
-    
-    def get_state(self, session_id: str) -> Optional[Dict]:
-        state_json = self.redis.get(f"session:{session_id}")
-        state = json.loads(state_json) if state_json else None
-        # logger.info(f"Retrieved state for session {session_id}: {state}")
 
-        return json.loads(state_json) if state_json else None
-    
+    def _remember(self, session_id: str, state: Dict) -> None:
+        self._sessions[session_id] = state
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.cache_size:
+            evicted_id, evicted_state = self._sessions.popitem(last=False)
+            self._stats["evictions"] += 1
+            if evicted_id in self._dirty:
+                # Still has to be written; stays readable until it is
+                self._evicted[evicted_id] = evicted_state
+            else:
+                self._saved.pop(evicted_id, None)
+
+    async def get_state(self, session_id: str) -> Optional[Dict]:
+        state = self._sessions.get(session_id)
+        if state is None and session_id in self._evicted:
+            state = self._evicted[session_id]
+        if state is not None:
+            self._stats["hits"] += 1
+            self._remember(session_id, state)
+            return state
+
+        self._stats["misses"] += 1
+        state = await self._load(session_id)
+        if state is not None:
+            self._remember(session_id, state)
+        return state
+
     def save_state(self, session_id: str, state: Dict) -> None:
-        # Convert state to a JSON-serializable format
-        state_copy = state.copy()
-        
-        # Extract just the conversation data we need
-        conversation_history = []
-        for msg in state_copy["conversation_history"]:
-            try:
-                # Try to access as an object
-                role = "user" if msg.__class__.__name__ == "HumanMessage" else "assistant"
-                content = msg.content
-            except AttributeError:
-                # Handle as a dictionary
-                role = msg.get("role")
-                content = msg.get("content")
-                
-            conversation_history.append({
-                "role": role,
-                "content": content
-            })
-        
-        state_copy["conversation_history"] = conversation_history
-        
-        self.redis.setex(
-            f"session:{session_id}",
-            self.session_ttl,
-            json.dumps(state_copy)
-        )
\ No newline at end of file
+        """
+        Update the in-memory copy; it's written to Redis by the next flush.
+        The caller compacts the history first (the turn loop does, once per turn).
+        """
+        self._evicted.pop(session_id, None)
+        self._remember(session_id, state)
+        self._dirty.setdefault(session_id, time.monotonic())
+
+    async def flush(self, session_id: Optional[str] = None) -> None:
+        """ Write back one dirty session, or all of them """
+        async with self._flush_lock:
+            session_ids = [session_id] if session_id is not None else list(self._dirty)
+            for session_id in session_ids:
+                dirty_since = self._dirty.pop(session_id, None)
+                if dirty_since is None:
+                    continue
+                state = self._sessions.get(session_id) or self._evicted.get(session_id)
+                try:
+                    await self._write(session_id, state)
+                except BaseException:
+                    # Try again on the next flush, still counting lag from the first change
+                    self._dirty.setdefault(session_id, dirty_since)
+                    self._stats["flush_errors"] += 1
+                    raise
+                self.latency.record("flush_lag", time.monotonic() - dirty_since)
+                self._stats["flushes"] += 1
+                if self._evicted.pop(session_id, None) is not None and session_id not in self._sessions:
+                    self._saved.pop(session_id, None)
+
+    async def _load(self, session_id: str) -> Optional[Dict]:
+        start = time.perf_counter()
+        hash_key, messages_key = self._keys(session_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(hash_key)
+        pipe.lrange(messages_key, 0, -1)
+        fields, messages = await pipe.execute()
+        fields = {key.decode(): value for key, value in fields.items()}
+        if not fields:
+            self.latency.record("redis.get", time.perf_counter() - start)
+            return None
+
+        blob_refs = {k: v[len(BLOB_REF_PREFIX):].decode() for k, v in fields.items() if k in BLOB_FIELDS and v.startswith(BLOB_REF_PREFIX)}
+        blobs = dict(zip(blob_refs, await self.redis.mget([f"session:blob:{digest}" for digest in blob_refs.values()]))) if blob_refs else {}
+        self.latency.record("redis.get", time.perf_counter() - start)
+
+        state = {}
+        for key, value in fields.items():
+            if key in (MESSAGES_START, MESSAGES_END):
+                continue
+            if key in blob_refs:
+                value = blobs[key]
+            state[key] = decode(value) if value is not None else None
+        state["conversation_history"] = [decode(message) for message in messages]
+        # logger.info(f"Retrieved state for session {session_id}: {state}")
+
+        self._saved[session_id] = dict(fields)
+        return state
+
+    async def _write(self, session_id: str, state: Dict) -> None:
+        start_time = time.perf_counter()
+        hash_key, messages_key = self._keys(session_id)
+
+        saved = self._saved.get(session_id)
+        if saved is None:
+            # Not written or loaded by this process yet: find out what's already stored
+            start, end = await self.redis.hmget(hash_key, [MESSAGES_START, MESSAGES_END])
+            saved = {MESSAGES_START: start, MESSAGES_END: end}
+
+        pipe = self.redis.pipeline(transaction=False)
+        written = 0
+
+        # Messages: state["conversation_history"][0] is message number folded_messages
+        history = state["conversation_history"]
+        first = state.get("folded_messages") or 0
+        start, end = int(saved[MESSAGES_START] or 0), int(saved[MESSAGES_END] or 0)
+        if end < first or end > first + len(history):
+            # Stored list doesn't line up with this history, start it over
+            pipe.delete(messages_key)
+            start = end = first
+        new_messages = [encode(m) for m in history[end - first:]]
+        if new_messages:
+            pipe.rpush(messages_key, *new_messages)
+            written += sum(len(m) for m in new_messages)
+        if first > start:
+            pipe.ltrim(messages_key, first - start, -1)
+
+        # Scalar fields and blob references: only the ones that changed
+        fields = {MESSAGES_START: str(first).encode(), MESSAGES_END: str(first + len(history)).encode()}
+        blob_keys = []
+        for key, value in state.items():
+            if key == "conversation_history":
+                continue
+            encoded = encode(value)
+            if key in BLOB_FIELDS and value is not None:
+                digest = hashlib.sha256(encoded).hexdigest()
+                ref = BLOB_REF_PREFIX + digest.encode()
+                blob_keys.append(f"session:blob:{digest}")
+                if saved.get(key) != ref:
+                    pipe.set(blob_keys[-1], encoded, ex=self.session_ttl, nx=True)
+                    written += len(encoded)
+                    self._stats["blobs_written"] += 1
+                encoded = ref
+            fields[key] = encoded
+
+        changed = {k: v for k, v in fields.items() if saved.get(k) != v}
+        removed = [k for k, v in saved.items() if k not in fields and v is not None]
+        if changed:
+            pipe.hset(hash_key, mapping=changed)
+            written += sum(len(k) + len(v) for k, v in changed.items())
+        if removed:
+            pipe.hdel(hash_key, *removed)
+
+        # One TTL for everything the session uses
+        for key in (hash_key, messages_key, *blob_keys):
+            pipe.expire(key, self.session_ttl)
+        await pipe.execute()
+        self.latency.record("redis.write", time.perf_counter() - start_time)
+
+        self._saved[session_id] = fields
+        self._stats["bytes_written"] += written
+
+    def stats(self) -> Dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+            "cached": len(self._sessions),
+            "dirty": len(self._dirty),
+            "oldest_dirty_s": round(time.monotonic() - min(self._dirty.values()), 3) if self._dirty else 0.0,
+            "latency": self.latency.summary(),
+        }
+
+
+# Shared store, only when Redis is configured
+session_store = SessionManager() if REDIS_URL else None
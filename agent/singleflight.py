@@ -0,0 +1,83 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical work: while a call for a key is running,
+    other callers with the same key wait for it and get the same result (or
+    the same exception) instead of running it again. Nothing is kept once the
+    call finishes, so this is not a cache.
+    """
+
+    def __init__(self, name: str, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self._tasks = set()
+        self._stats = {"executions": 0, "coalesced": 0, "errors": 0}
+
+    def join(self, key: Hashable) -> Optional[asyncio.Future]:
+        """ The in-flight future for `key`, if another caller is already running it """
+        if not self.enabled:
+            return None
+        future = self._flights.get(key)
+        if future is not None:
+            self._stats["coalesced"] += 1
+        return future
+
+    def begin(self, key: Hashable) -> asyncio.Future:
+        """ Register the caller as the one running `key`; it must call finish() or fail() """
+        future = asyncio.get_running_loop().create_future()
+        # Waiters that never show up shouldn't trigger "exception was never retrieved"
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if self.enabled:
+            self._flights[key] = future
+        self._stats["executions"] += 1
+        return future
+
+    def finish(self, key: Hashable, future: asyncio.Future, result: Any) -> None:
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        if not future.done():
+            future.set_result(result)
+
+    def fail(self, key: Hashable, future: asyncio.Future, error: BaseException) -> None:
+        if self._flights.get(key) is future:
+            del self._flights[key]
+        self._stats["errors"] += 1
+        if future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(error)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """ Run `func` for `key`, or wait for the call already running it """
+        future = self.join(key)
+        if future is None:
+            future = self.begin(key)
+
+            # Run in its own task so a cancelled caller doesn't cancel everyone's result
+            async def run():
+                try:
+                    self.finish(key, future, await func())
+                except BaseException as e:
+                    self.fail(key, future, e)
+
+            task = asyncio.ensure_future(run())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict:
+        return {**self._stats, "in_flight": len(self._flights), "enabled": self.enabled}
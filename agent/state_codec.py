@@ -0,0 +1,88 @@
+import json
+import os
+from typing import Any
+
+import msgpack
+from dotenv import load_dotenv
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from schema import AudienceSelections, ProductSearchResults, SelectedCategory
+
+try:
+    import zstandard
+except ImportError:  # Optional: payloads are just stored uncompressed
+    zstandard = None
+
+load_dotenv()
+
+# Payloads at least this big (bytes, before compression) are zstd-compressed
+STATE_COMPRESS_THRESHOLD = int(os.getenv("STATE_COMPRESS_THRESHOLD", "1024"))
+STATE_COMPRESS_LEVEL = int(os.getenv("STATE_COMPRESS_LEVEL", "3"))
+
+# Every payload starts with two bytes: the codec version and flags
+CODEC_VERSION = 1
+FLAG_ZSTD = 0x01
+
+# msgpack extension codes for the objects found in AudienceBuilderState.
+# Codes are part of the format: add new ones, never renumber.
+MESSAGE_TYPES = {1: HumanMessage, 2: AIMessage, 3: SystemMessage}
+MODEL_TYPES = {16: ProductSearchResults, 17: AudienceSelections, 18: SelectedCategory}
+_EXT_CODES = {cls: code for code, cls in {**MESSAGE_TYPES, **MODEL_TYPES}.items()}
+
+
+def _default(obj: Any) -> msgpack.ExtType:
+    code = _EXT_CODES.get(type(obj))
+    if code is None:
+        raise TypeError(f"Can't encode {type(obj).__name__} in conversation state")
+    # Defaults are left out (message type, empty kwargs...) and restored on decode
+    return msgpack.ExtType(code, _pack(obj.model_dump(exclude_defaults=True)))
+
+
+def _ext_hook(code: int, data: bytes) -> Any:
+    if code in MESSAGE_TYPES:
+        return MESSAGE_TYPES[code](**_unpack(data))
+    if code in MODEL_TYPES:
+        return MODEL_TYPES[code].model_validate(_unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def _pack(value: Any) -> bytes:
+    return msgpack.packb(value, default=_default, use_bin_type=True)
+
+
+def _unpack(data: bytes) -> Any:
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+def encode(value: Any, compress_threshold: int = STATE_COMPRESS_THRESHOLD) -> bytes:
+    """
+    Encode a state (or any value in one) as versioned msgpack. Messages,
+    search results and audience selections keep their types. Payloads over
+    compress_threshold bytes are zstd-compressed when zstandard is installed.
+    """
+    body, flags = _pack(value), 0
+    if zstandard is not None and compress_threshold is not None and len(body) >= compress_threshold:
+        compressed = zstandard.ZstdCompressor(level=STATE_COMPRESS_LEVEL).compress(body)
+        if len(compressed) < len(body):
+            body, flags = compressed, FLAG_ZSTD
+    return bytes((CODEC_VERSION, flags)) + body
+
+
+def decode(data: bytes) -> Any:
+    """ Inverse of encode(). JSON text written before the codec existed is still read. """
+    if not data:
+        raise ValueError("Empty state payload")
+
+    version = data[0]
+    if version >= 0x20:
+        # Printable first byte: a JSON payload from the old format
+        return json.loads(data)
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unsupported state codec version {version}")
+
+    flags, body = data[1], data[2:]
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("State payload is zstd-compressed but zstandard isn't installed")
+        body = zstandard.ZstdDecompressor().decompress(body)
+    return _unpack(body)
@@ -1,14 +1,39 @@
+import os
 import sqlite3
-import json
+import time
 
 from langchain.tools import BaseTool
-from typing import Type, ClassVar
+from typing import Type, ClassVar, Dict, Iterable, Optional, Tuple, Union
 from pydantic import BaseModel, Field
-from schema import ProductDetails, ProductSearchResults
+from schema import ProductDetails, ProductSearchResults, SKUBatchResults, CategoryCount
+from search_index import search_products_page, count_matches_by_category, SEARCH_LIMIT
+from db import get_connection_manager
+from cache import TTLCache
+from fuzzy_match import get_matcher, fetch_rows
+from archive import search_archive
 
-from collections import defaultdict
+SKU_LOOKUP_QUERY = """
+SELECT skuId, skuName, catLevel4Name, catLevel5Name
+FROM DIM_ITEMS
+WHERE skuId = ?
+"""
 
-DB_PATH = "/home/azureuser/projects/whizzbang_audience/db/db.db"
+# Product searches keyed on the normalized query, cleared when the catalog changes
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "512"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))
+search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+# Full rank order per query for "load more" pages, 16 bytes per match
+RANKING_CACHE_SIZE = int(os.getenv("RANKING_CACHE_SIZE", "32"))
+ranking_cache = TTLCache(maxsize=RANKING_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+
+# How the trigram matcher is used for product names:
+#   "fallback" - only when the FTS/LIKE search finds nothing (typos, "kitkat")
+#   "primary"  - rank every search with it
+#   "off"      - never build it
+FUZZY_MATCH_MODE = os.getenv("FUZZY_MATCH_MODE", "fallback")
+
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER (999 on older builds)
+SKU_BATCH_SIZE = 500
 
 class SKULookupInput(BaseModel):
     sku: str = Field(..., description="The product SKU to lookup")
@@ -23,21 +48,10 @@ class SKULookupTool(BaseTool):
 
     def _run(self, sku: str) -> ProductDetails:
         """ Query the database for product details """
-        db_path = DB_PATH
-
         try:
             print(f"Querying database for SKU: {sku}")
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            query = """
-            SELECT skuId, skuName, catLevel4Name, catLevel5Name
-            FROM DIM_ITEMS
-            WHERE skuId = ?
-            """
-            cursor.execute(query, (sku,))
-            result = cursor.fetchone()
-            conn.close()
+            with get_connection_manager().connection() as conn:
+                result = conn.execute(SKU_LOOKUP_QUERY, (sku,)).fetchone()
 
             print(result)
 
@@ -53,6 +67,45 @@ class SKULookupTool(BaseTool):
             
         except sqlite3.Error as e:
             raise ValueError(f"DB Error: {e}")
+
+    def lookup_many(self, skus: Iterable[Union[str, int]], batch_size: int = SKU_BATCH_SIZE) -> SKUBatchResults:
+        """
+        Resolve many SKUs with one chunked IN (...) query per batch.
+        Missing SKUs are reported in not_found instead of raising.
+        """
+        # Dedupe while keeping the caller's order
+        wanted = list(dict.fromkeys(str(sku).strip() for sku in skus if str(sku).strip()))
+        found = {}
+
+        try:
+            print(f"Querying database for {len(wanted)} SKUs")
+            with get_connection_manager().connection() as conn:
+                for start in range(0, len(wanted), batch_size):
+                    batch = wanted[start:start + batch_size]
+                    placeholders = ", ".join("?" * len(batch))
+                    query = f"""
+                    SELECT skuId, skuName, catLevel4Name, catLevel5Name
+                    FROM DIM_ITEMS
+                    WHERE skuId IN ({placeholders})
+                    """
+                    for row in conn.execute(query, batch):
+                        found[str(row[0])] = ProductDetails(
+                            sku=row[0],
+                            product_name=row[1],
+                            buyer_category=row[2],
+                            product_category=row[3]
+                        )
+
+        except sqlite3.Error as e:
+            raise ValueError(f"DB Error: {e}")
+
+        not_found = [sku for sku in wanted if sku not in found]
+        print(f"Found {len(found)} of {len(wanted)} SKUs")
+
+        return SKUBatchResults(
+            found={sku: found[sku] for sku in wanted if sku in found},
+            not_found=not_found
+        )
         
 
 class ProductLookupTool(BaseTool):
@@ -61,166 +114,176 @@ class ProductLookupTool(BaseTool):
     args_schema: ClassVar[Type[BaseModel]] = ProductLookupInput
 
     def _run(self, name: str) -> ProductSearchResults:
-        """ Query the database for product details and group by categories """
-        db_path = DB_PATH
+        """ Query the database for the first page of product details and group by categories """
+        start = time.perf_counter()
+        db = get_connection_manager()
+        cache_key = normalize_query(name)
 
         try:
+            search_cache.check_version(db.catalog_version())
+
+            cached = search_cache.get(cache_key)
+            if cached is not None:
+                print(f"Search cache hit for name: {name}")
+                return cached
+
             print(f"Querying database for name: {name}")
-            conn = sqlite3.connect(db_path)
-            cursor = conn.cursor()
-
-            query = """
-            SELECT 
-                skuId,
-                skuName,
-                catLevel4Name,
-                catLevel5Name
-            FROM 
-                DIM_ITEMS
-            WHERE 
-                (
-                    skuName LIKE ? || '%' OR
-                    skuName LIKE '%' || ? OR
-                    skuName LIKE '%' || ? || '%'
-                )
-                AND catLevel4Name != 'NOT IN USE'
-                AND catLevel5Name != 'NOT IN USE'
-            ORDER BY 
-                CASE
-                    WHEN skuName = ? THEN 10
-                    WHEN skuName LIKE ? || '%' THEN 8
-                    WHEN skuName LIKE '%' || ? || '%' THEN 6
-                    ELSE 1
-                END DESC
-            LIMIT 50;
-            """
-            
-            params = (name, name, name, name, name, name)
-            cursor.execute(query, params)
-            
-            results = cursor.fetchall()
-            conn.close()
+            results, match_counts, next_cursor = [], {}, None
+            if FUZZY_MATCH_MODE != "primary":
+                with db.connection() as conn:
+                    results, next_cursor = search_products_page(conn, name, use_index=db.search_index_ready)
+                    # Per-category match counts over the whole index, not just the LIMIT
+                    match_counts = count_matches_by_category(conn, name) if db.search_index_ready else {}
+
+            if not results and FUZZY_MATCH_MODE != "off":
+                matches = get_matcher(db).search(name, k=SEARCH_LIMIT)
+                with db.connection() as conn:
+                    results = fetch_rows(conn, [rowid for rowid, score in matches])
+                print(f"Trigram matcher found {len(results)} results for name: {name}")
 
             print(f"Found {len(results)} results")
             
             if results:
-                # Build a dictionary to group products by categories
-                by_buyer_category = defaultdict(list)
-                by_product_category = defaultdict(list)
-                
-                # Also track unique categories
-                unique_buyer_categories = set()
-                unique_product_categories = set()
-                
-                # Process all results
-                all_products = []
-                for row in results:
-                    sku_id = row[0]
-                    product_name = row[1]
-                    buyer_category = row[2]
-                    product_category = row[3]
-
-                    if buyer_category == 'NOT IN USE' or product_category == 'NOT IN USE':
-                        print(f"Filtering out product {product_name} with category 'NOT IN USE'")
-                        continue
-                    
-                    # Create product object
-                    product = ProductDetails(
-                        sku=sku_id,
-                        product_name=product_name,
-                        buyer_category=buyer_category,
-                        product_category=product_category
-                    )
-                    
-                    # Add to our collections
-                    all_products.append(product)
-                    by_buyer_category[buyer_category].append(product)
-                    by_product_category[product_category].append(product)
-                    
-                    # Track unique categories
-                    unique_buyer_categories.add(buyer_category)
-                    unique_product_categories.add(product_category)
-                
-                # Build the response object
-                response = ProductSearchResults(
-                    query=name,
-                    total_results=len(results),
-                    unique_buyer_categories=list(unique_buyer_categories),
-                    unique_product_categories=list(unique_product_categories),
-                    by_buyer_category=dict(by_buyer_category),
-                    by_product_category=dict(by_product_category),
-                    all_products=all_products
-                )
-                
-                print(f"\nFound products in {len(unique_buyer_categories)} buyer categories and {len(unique_product_categories)} product categories\n")
-                
-                with open("res.json", "w") as f:
-                    # Convert to dict first
-                    result_dict = response.model_dump()
-                    json.dump(result_dict, f)
-                
+                response = self._build_results(name, results, match_counts, next_cursor)
+
+                print(f"\nFound products in {len(response.buyer_categories)} buyer categories and {len(response.product_categories)} product categories\n")
+
+                search_archive.record({
+                    "query": name,
+                    "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+                    "total_results": response.total_results,
+                    "total_matches": response.total_matches,
+                    "buyer_categories": response.buyer_categories,
+                    "product_categories": response.product_categories,
+                    "top_skus": response.skus[:10],
+                })
+
+                search_cache.set(cache_key, response)
                 return response
             else:
                 raise ValueError(f"Product with name {name} not found")
             
         except sqlite3.Error as e:
             raise ValueError(f"DB Error: {e}")
+
+    def next_page(self, name: str, cursor: str, page_size: int = SEARCH_LIMIT) -> ProductSearchResults:
+        """ Fetch the page after `cursor` (from a previous result's next_cursor) """
+        db = get_connection_manager()
+
+        try:
+            print(f"Querying database for name: {name}, next page")
+            ranking_cache.check_version(db.catalog_version())
+            # Reuse the whole-catalog counts from the first page when it's cached
+            first_page = search_cache.get(normalize_query(name))
+            with db.connection() as conn:
+                results, next_cursor = search_products_page(
+                    conn, name, cursor=cursor, use_index=db.search_index_ready, limit=page_size,
+                    ranking_cache=ranking_cache
+                )
+                if first_page is not None:
+                    match_counts = {
+                        (c.buyer_category, c.product_category): c.count for c in first_page.category_match_counts
+                    }
+                else:
+                    match_counts = count_matches_by_category(conn, name) if db.search_index_ready else {}
+
+        except sqlite3.Error as e:
+            raise ValueError(f"DB Error: {e}")
+
+        return self._build_results(name, results, match_counts, next_cursor)
+
+    @staticmethod
+    def _build_results(name: str, results: list, match_counts: Dict, next_cursor: Optional[str]) -> ProductSearchResults:
+        rows = []
+        for row in results:
+            if row[2] == 'NOT IN USE' or row[3] == 'NOT IN USE':
+                print(f"Filtering out product {row[1]} with category 'NOT IN USE'")
+                continue
+            rows.append(row)
+
+        return ProductSearchResults.from_rows(
+            name,
+            rows,
+            total_results=len(results),
+            total_matches=sum(match_counts.values()) if match_counts else None,
+            category_match_counts=[
+                CategoryCount(buyer_category=buyer_cat, product_category=product_cat, count=count)
+                for (buyer_cat, product_cat), count in match_counts.items()
+            ],
+            next_cursor=next_cursor
+        )
         
 
-def transform_to_product_table(product_search_results: ProductSearchResults):
+def normalize_query(name: str) -> str:
+    """ Case and whitespace insensitive cache key for a product search """
+    return " ".join(name.lower().split())
+
+
+def transform_to_product_table(
+    product_search_results: ProductSearchResults,
+    category_totals: Optional[Dict[Tuple[str, str], int]] = None
+):
     """
     Transform ProductSearchResults into a structured table format with:
     - Buyer Category
     - Product Category
     - Sample SKUs
-    - Total SKU Count
-    
+    - Total SKU Count (matching the query, across the whole catalog)
+    - Category SKU Count (every SKU in the category)
+
+    category_totals defaults to the rollup loaded by the connection manager.
     Returns a dictionary with the table data and metadata
     """
-    # Create a structure to track unique buyer/product category combinations
+    if category_totals is None:
+        category_totals = get_connection_manager().category_rollup
+
+    match_counts = {
+        (c.buyer_category, c.product_category): c.count
+        for c in product_search_results.category_match_counts
+    }
+
+    buyer_categories = product_search_results.buyer_categories
+    product_categories = product_search_results.product_categories
+
+    # One pass over the columns, grouped on the interned (buyer id, product id) pair
     category_combinations = {}
-    
-    # Group products by buyer category and product category
-    for product in product_search_results.all_products:
-        buyer_cat = product.buyer_category
-        product_cat = product.product_category
-        
-        # Create a unique key for this combination
-        combo_key = f"{buyer_cat}|||{product_cat}"
-        
-        if combo_key not in category_combinations:
-            category_combinations[combo_key] = {
-                "buyer_category": buyer_cat,
-                "product_category": product_cat,
+    for sku, name, buyer_id, product_id in zip(
+        product_search_results.skus,
+        product_search_results.names,
+        product_search_results.buyer_category_ids,
+        product_search_results.product_category_ids
+    ):
+        row = category_combinations.get((buyer_id, product_id))
+        if row is None:
+            row = category_combinations[(buyer_id, product_id)] = {
+                "buyer_category": buyer_categories[buyer_id],
+                "product_category": product_categories[product_id],
                 "skus": [],
                 "count": 0
             }
-        
-        # Add this product's SKU to the list (if not already at 5)
-        if len(category_combinations[combo_key]["skus"]) < 5:
-            category_combinations[combo_key]["skus"].append({
-                "sku": product.sku,
-                "name": product.product_name
-            })
-        
-        # Increment the count
-        category_combinations[combo_key]["count"] += 1
-    
+
+        # Keep up to 5 sample SKUs per combination
+        if len(row["skus"]) < 5:
+            row["skus"].append({"sku": sku, "name": name})
+
+        row["count"] += 1
+
     # Convert to a list of rows for easier frontend rendering
     table_rows = list(category_combinations.values())
+
+    # Swap the sampled counts for the full ones where we have them
+    for row in table_rows:
+        key = (row["buyer_category"], row["product_category"])
+        row["count"] = match_counts.get(key, row["count"])
+        row["category_total"] = category_totals.get(key)
     
     # Create the final structure
     table_data = {
         "query": product_search_results.query,
         "total_results": product_search_results.total_results,
+        "total_matches": product_search_results.total_matches,
+        "next_cursor": product_search_results.next_cursor,
         "rows": table_rows
     }
     
     return table_data
-        
-
-            
-
-
-
-
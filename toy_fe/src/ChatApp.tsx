@@ -15,6 +15,10 @@ const renderMarkdown = (content: string) => (
   </Typography>
 );
 
+// Session token from the server, kept for the tab so a reload or dropped connection resumes
+const SESSION_KEY = "pollen_session";
+const RECONNECT_DELAY_MS = 1000;
+
 // Define types for selected categories
 interface SelectedCategory {
   buyer_category: string;
@@ -22,10 +26,30 @@ interface SelectedCategory {
   key: string | number;
 }
 
+// Merge a table_page delta into a table: known category rows get extra sample
+// SKUs (up to 5), new category rows are appended
+const mergeTablePage = (table: any, page: any) => {
+  const rows = table.rows.map((row: any) => ({ ...row, skus: [...row.skus] }));
+
+  for (const pageRow of page.rows) {
+    const existing = rows.find((row: any) =>
+      row.buyer_category === pageRow.buyer_category && row.product_category === pageRow.product_category
+    );
+    if (existing) {
+      existing.skus = [...existing.skus, ...pageRow.skus].slice(0, 5);
+      existing.count = Math.max(existing.count, pageRow.count);
+    } else {
+      rows.push(pageRow);
+    }
+  }
+
+  return { ...table, rows, next_cursor: page.next_cursor };
+};
+
 const ChatApp = () => {
   const [content, setContent] = useState("");
   const webSocketRef = useRef<WebSocket | null>(null);
-  const [messages, setMessages] = useState<{ id: number; message: any; role: "ai" | "local" }[]>([]);
+  const [messages, setMessages] = useState<{ id: number; message: any; role: "ai" | "local"; streamId?: string }[]>([]);
   const [threadId, setThreadId] = useState<string | null>(null);
   const [connecting, setConnecting] = useState(true);
 
@@ -56,6 +80,21 @@ const ChatApp = () => {
     // }]);
   };
 
+  // Ask the backend for the next page of a product table
+  const requestTablePage = (tableId: string, query: string, cursor: string) => {
+    if (!webSocketRef.current || webSocketRef.current.readyState !== WebSocket.OPEN) {
+      console.error("WebSocket is not connected.");
+      return;
+    }
+
+    webSocketRef.current.send(JSON.stringify({
+      type: "table_page_request",
+      table_id: tableId,
+      query,
+      cursor
+    }));
+  };
+
   // Function to handle selection from the table
   const handleSelectionApplied = (selected: SelectedCategory[]) => {
     // Send to backend
@@ -75,6 +114,7 @@ const ChatApp = () => {
         <ComplexMessage 
           content={content} 
           onSelectionApplied={handleSelectionApplied}
+          onLoadMore={requestTablePage}
         />
       ),
     },
@@ -86,57 +126,107 @@ const ChatApp = () => {
   };
 
   useEffect(() => {
-    const ws = new WebSocket("ws://localhost:8000/ws");
-    webSocketRef.current = ws;
+    let closed = false;
 
-    ws.onopen = () => {
-      console.log("WebSocket connected");
-      setConnecting(false);
-    };
+    const connect = () => {
+      // Present the token from an earlier connection so the server resumes that session
+      const token = sessionStorage.getItem(SESSION_KEY);
+      const ws = new WebSocket(`ws://localhost:8000/ws${token ? `?session=${encodeURIComponent(token)}` : ""}`);
+      webSocketRef.current = ws;
 
-    ws.onclose = () => {
-      console.log("WebSocket disconnected");
-      setConnecting(true);
-    };
+      ws.onopen = () => {
+        console.log("WebSocket connected");
+        setConnecting(false);
+      };
 
-    ws.onmessage = (event) => {
-      const data = event.data;
-      console.log("Received message:", data);
+      ws.onclose = () => {
+        console.log("WebSocket disconnected");
+        setConnecting(true);
+        if (!closed) {
+          setTimeout(connect, RECONNECT_DELAY_MS);
+        }
+      };
+
+      ws.onmessage = (event) => {
+        const data = event.data;
+        console.log("Received message:", data);
     
-      if (typeof data === "string" && data.startsWith("THREAD_ID:")) {
-        setThreadId(data.substring(10));
-        return;
-      }
+        if (typeof data === "string" && data.startsWith("THREAD_ID:")) {
+          setThreadId(data.substring(10));
+          return;
+        }
     
-      // Try to parse the message as JSON, if it fails, treat it as plain text
-      try {
-        const jsonData = JSON.parse(data);
+        // Try to parse the message as JSON, if it fails, treat it as plain text
+        try {
+          const jsonData = JSON.parse(data);
         
-        // Handle different types of messages
-        if (jsonData.type === "complex") {
-          setMessages((prev) => [...prev, { 
-            id: prev.length, 
-            message: { 
-              text: jsonData.text, 
-              table: jsonData.table 
-            }, 
-            role: "ai" 
-          }]);
-        } else if (jsonData.type === "selection_received") {
-          // Handle audience selection confirmation
-          setMessages((prev) => [...prev, { 
-            id: prev.length, 
-            message: jsonData.message, 
-            role: "ai" 
-          }]);
-        } else {
-          // Handle other JSON responses
-          setMessages((prev) => [...prev, { id: prev.length, message: jsonData, role: "ai" }]);
+          // Handle different types of messages
+          if (jsonData.type === "complex") {
+            setMessages((prev) => [...prev, { 
+              id: prev.length, 
+              message: { 
+                text: jsonData.text, 
+                table: jsonData.table 
+              }, 
+              role: "ai" 
+            }]);
+          } else if (jsonData.type === "stream_start") {
+            // Open an empty bubble that stream_delta messages will fill in
+            setMessages((prev) => [...prev, { id: prev.length, message: "", role: "ai", streamId: jsonData.id }]);
+          } else if (jsonData.type === "stream_delta") {
+            setMessages((prev) => prev.map((msg) =>
+              msg.streamId === jsonData.id ? { ...msg, message: msg.message + jsonData.delta } : msg
+            ));
+          } else if (jsonData.type === "stream_end") {
+            // Swap in the final content, with the product table if there is one
+            setMessages((prev) => prev.map((msg) =>
+              msg.streamId === jsonData.id
+                ? { ...msg, message: jsonData.table ? { text: jsonData.text, table: jsonData.table } : jsonData.text }
+                : msg
+            ));
+          } else if (jsonData.type === "table_page") {
+            // Append a page of rows to the table it belongs to
+            setMessages((prev) => prev.map((msg) =>
+              msg.message?.table?.table_id === jsonData.table_id
+                ? { ...msg, message: { ...msg.message, table: mergeTablePage(msg.message.table, jsonData) } }
+                : msg
+            ));
+          } else if (jsonData.type === "session") {
+            sessionStorage.setItem(SESSION_KEY, jsonData.token);
+            // After a reload the list is empty: show where the conversation left off
+            const replay = jsonData.replay;
+            if (replay) {
+              setMessages((prev) => prev.length ? prev : [{
+                id: 0,
+                message: replay.table ? { text: replay.text, table: replay.table } : replay.text,
+                role: "ai"
+              }]);
+            }
+          } else if (jsonData.type === "busy") {
+            // The backend queued our LLM call; the reply will still arrive
+            message.info(jsonData.message);
+          } else if (jsonData.type === "selection_received") {
+            // Handle audience selection confirmation
+            setMessages((prev) => [...prev, { 
+              id: prev.length, 
+              message: jsonData.message, 
+              role: "ai" 
+            }]);
+          } else {
+            // Handle other JSON responses
+            setMessages((prev) => [...prev, { id: prev.length, message: jsonData, role: "ai" }]);
+          }
+        } catch (e) {
+          // If not JSON, treat as plain text
+          setMessages((prev) => [...prev, { id: prev.length, message: data, role: "ai" }]);
         }
-      } catch (e) {
-        // If not JSON, treat as plain text
-        setMessages((prev) => [...prev, { id: prev.length, message: data, role: "ai" }]);
-      }
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      webSocketRef.current?.close();
     };
   }, []);
   const sendMessage = (message: string) => {
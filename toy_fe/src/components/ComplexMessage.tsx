@@ -17,11 +17,15 @@ interface TableRow {
   product_category: string;
   skus: TableSku[];
   count: number;
+  category_total?: number | null;
 }
 
 interface ProductTableData {
   query: string;
   total_results: number;
+  total_matches?: number | null;
+  next_cursor?: string | null;
+  table_id?: string;
   rows: TableRow[];
 }
 
@@ -47,10 +51,12 @@ interface SelectedCategory {
 // Define custom message component to handle complex messages
 const ComplexMessage = ({ 
   content, 
-  onSelectionApplied 
+  onSelectionApplied,
+  onLoadMore
 }: { 
   content: MessageContent, 
-  onSelectionApplied?: (selected: SelectedCategory[]) => void
+  onSelectionApplied?: (selected: SelectedCategory[]) => void,
+  onLoadMore?: (tableId: string, query: string, cursor: string) => void
 }) => {
   // Function to render markdown content
   const renderMarkdown = (text: string) => {
@@ -75,6 +81,7 @@ const ComplexMessage = ({
           <InteractiveProductTable 
             tableData={content.table} 
             onSelectionApplied={onSelectionApplied}
+            onLoadMore={onLoadMore}
           />
         )}
       </div>
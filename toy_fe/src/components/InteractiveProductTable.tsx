@@ -12,12 +12,16 @@ interface TableRow {
   product_category: string;
   skus: TableSku[];
   count: number;
+  category_total?: number | null;
   key?: string | number;
 }
 
 interface ProductTableData {
   query: string;
   total_results: number;
+  total_matches?: number | null;
+  next_cursor?: string | null;
+  table_id?: string;
   rows: TableRow[];
 }
 
@@ -30,10 +34,12 @@ interface SelectedCategory {
 // Define the component to render product tables with selection
 const InteractiveProductTable = ({ 
   tableData,
-  onSelectionApplied
+  onSelectionApplied,
+  onLoadMore
 }: { 
   tableData: ProductTableData, 
-  onSelectionApplied?: (selected: SelectedCategory[]) => void 
+  onSelectionApplied?: (selected: SelectedCategory[]) => void,
+  onLoadMore?: (tableId: string, query: string, cursor: string) => void
 }) => {
   const [selectedRows, setSelectedRows] = useState<SelectedCategory[]>([]);
 
@@ -85,6 +91,12 @@ const InteractiveProductTable = ({
       dataIndex: 'count',
       key: 'count',
     },
+    {
+      title: 'SKUs in Category',
+      dataIndex: 'category_total',
+      key: 'category_total',
+      render: (total?: number | null) => total ?? '-',
+    },
     {
       title: 'Action',
       key: 'action',
@@ -119,6 +131,17 @@ const InteractiveProductTable = ({
           return isSelected ? 'ant-table-row-selected' : '';
         }}
       />
+
+      {tableData.next_cursor && tableData.table_id && onLoadMore && (
+        <div style={{ display: 'flex', justifyContent: 'center' }}>
+          <Button
+            size="small"
+            onClick={() => onLoadMore(tableData.table_id as string, tableData.query, tableData.next_cursor as string)}
+          >
+            Load more results
+          </Button>
+        </div>
+      )}
       
       <div style={{ marginTop: '16px', borderTop: '1px solid #f0f0f0', paddingTop: '16px' }}>
         {selectedRows.length > 0 ? (